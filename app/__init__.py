@@ -20,16 +20,21 @@ from logging.config import dictConfig
 from werkzeug.middleware.proxy_fix import ProxyFix
 import app.kafka_interface as ki
 import app.ranking_processor as rp
+from app.lib import db
+from app.lib import profiling
+from app.lib.store import VALID_STORE_BACKENDS
+from app.lib.codec import CodecJSONProvider
 from app.ranking_service import cpr_bp
 from apscheduler.schedulers.background import BackgroundScheduler
 # from testing import populate_kafka
 
-def create_app():
+def create_app(ingester=False):
     app = Flask(__name__, instance_relative_config=True)
     app.wsgi_app = ProxyFix(app.wsgi_app)
     # read configuration file
     if os.environ.get("TESTING", "").lower() == "true":
-        app.config.from_file("../tests/resources/config.json", json.load)
+        # relative to the package, the instance folder may not exist
+        app.config.from_file(os.path.join(app.root_path, os.pardir, "tests", "resources", "config.json"), json.load)
     else:
         if os.path.exists(os.path.join(app.instance_path, "config.json")):
             app.config.from_file("config.json", json.load)
@@ -44,16 +49,46 @@ def create_app():
 
     # Kafka parameteres
     db_connection = app.config.get("DB_CONNECTION", "file:ranking_database?mode=memory&cache=shared")
+    db_persistent = app.config.get("DB_PERSISTENT", False)
     ranking_topic = app.config.get("KAFKA_RANKING_TOPIC", "ranked-providers")
+    ingest_batch_size = int(app.config.get("KAFKA_INGEST_BATCH_SIZE", 500))
+    ingest_flush_interval_ms = int(app.config.get("KAFKA_INGEST_FLUSH_INTERVAL_MS", 1000))
+    ingest_mode = app.config.get("INGEST_MODE", "embedded")
+    db_poll_interval = float(app.config.get("DB_POLL_INTERVAL", 0.05))
+    db_mmap_size = int(app.config.get("DB_MMAP_SIZE", 64 * 1024 * 1024))
+    db_cache_size_kb = int(app.config.get("DB_CACHE_SIZE_KB", 16384))
+    db_synchronous = app.config.get("DB_SYNCHRONOUS", "NORMAL")
+    db_compression = app.config.get("DB_COMPRESSION", "none")
     bootstrap_servers = app.config.get(
         "KAFKA_BOOTSTRAP_SERVERS", "localhost:9092"
     ).split(",")
     messages_lifespan = app.config.get("MESSAGES_LIFESPAN", 5)
+    retention_interval = int(app.config.get("RETENTION_INTERVAL", 60))
+    retention_batch_size = int(app.config.get("RETENTION_BATCH_SIZE", 1000))
+    retention_max_batches = int(app.config.get("RETENTION_MAX_BATCHES", 100))
+    retention_vacuum = app.config.get("RETENTION_VACUUM", "none")
+    snapshot_path = app.config.get("SNAPSHOT_PATH", None)
+    snapshot_interval = int(app.config.get("SNAPSHOT_INTERVAL", 300))
+    store_backend = app.config.get("STORE_BACKEND", "sqlite")
+    mmap_store_path = app.config.get("MMAP_STORE_PATH", None)
+    cache_size = app.config.get("CACHE_SIZE", 10000)
+    negative_cache_ttl = float(app.config.get("NEGATIVE_CACHE_TTL", 0))
+    readiness_gate = app.config.get("READINESS_GATE", True)
     kafka_ssl_enable = app.config.get("KAFKA_SSL_ENABLE", False)
     kafka_ssl_ca_path = app.config.get("KAFKA_SSL_CACERT_PATH", None)
     kafka_ssl_cert_path = app.config.get("KAFKA_SSL_CERT_PATH", None)
     kafka_ssl_key_path = app.config.get("KAFKA_SSL_KEY_PATH", None)
     kafka_ssl_password = app.config.get("KAFKA_SSL_PASSWORD", None)
+    json_codec = app.config.get("JSON_CODEC", "auto")
+    profiling_enabled = app.config.get("PROFILING", False)
+    profiling_log_sample_rate = float(app.config.get("PROFILING_LOG_SAMPLE_RATE", 0.01))
+    kafka_fetch_min_bytes = int(app.config.get("KAFKA_FETCH_MIN_BYTES", 1))
+    kafka_fetch_max_wait_ms = int(app.config.get("KAFKA_FETCH_MAX_WAIT_MS", 500))
+    kafka_max_poll_records = int(app.config.get("KAFKA_MAX_POLL_RECORDS", 500))
+    kafka_receive_buffer_bytes = app.config.get("KAFKA_RECEIVE_BUFFER_BYTES", None)
+    kafka_compression_type = app.config.get("KAFKA_COMPRESSION_TYPE", None)
+    kafka_linger_ms = int(app.config.get("KAFKA_LINGER_MS", 5))
+    kafka_batch_size = int(app.config.get("KAFKA_BATCH_SIZE", 16384))
 
     # set kafka server parameters
     ki.set_global_vars(
@@ -64,20 +99,62 @@ def create_app():
         k_ssl_cert_path=kafka_ssl_cert_path,
         k_ssl_key_path=kafka_ssl_key_path,
         k_ssl_password=kafka_ssl_password,
+        k_json_codec=json_codec,
     )
+    ki.set_client_options(
+        fetch_min_bytes=kafka_fetch_min_bytes,
+        fetch_max_wait_ms=kafka_fetch_max_wait_ms,
+        max_poll_records=kafka_max_poll_records,
+        receive_buffer_bytes=kafka_receive_buffer_bytes,
+        compression_type=kafka_compression_type,
+        linger_ms=kafka_linger_ms,
+        batch_size=kafka_batch_size,
+    )
+
+    # serialize JSON responses with the same codec
+    app.json = CodecJSONProvider(app)
+    app.json.codec = ki.codec
+    app.logger.info(f"Using the '{ki.codec.name}' JSON codec")
+
+    validate_ingest_mode(ingest_mode, db_connection)
+    validate_retention_vacuum(retention_vacuum)
+    validate_db_compression(db_compression)
+    validate_store_backend(store_backend, ingest_mode, mmap_store_path, snapshot_path)
+    # web workers only read the store when a standalone ingester writes it
+    embedded_ingest = ingest_mode == "embedded" or ingester
+    rp.set_ingest_mode(local=embedded_ingest, poll_interval=db_poll_interval)
+    rp.set_readiness_gate(readiness_gate)
+
+    # opt-in timings of the /rank phases and /admin/profile
+    profiling.configure(profiling_enabled, profiling_log_sample_rate)
+
+    # PRAGMAs of the per-thread database connections
+    db.configure(mmap_size=db_mmap_size, cache_size_kb=db_cache_size_kb, synchronous=db_synchronous)
+
+    # in-memory ranking cache in front of the database
+    rp.configure_cache(cache_size, messages_lifespan, negative_cache_ttl)
 
     # check and create database if not exists
-    rp.check_database(app.logger)
+    # a store left empty is seeded from the last snapshot, if any
+    rp.check_database(app.logger, persistent=db_persistent or not embedded_ingest,
+                      vacuum=retention_vacuum if embedded_ingest else 'none',
+                      snapshot_path=snapshot_path if embedded_ingest else None)
+
+    # storage backend of the rankings, checked database first: the mmap files are rebuilt from it
+    rp.configure_store(store_backend, app.logger, compression=db_compression, vacuum=retention_vacuum,
+                       mmap_path=mmap_store_path, writer=embedded_ingest, track_changes=ingest_mode == "external")
 
     # write test data in topic
     # populate_kafka.write_test_data(ranking_topic)
 
     app.scheduler = BackgroundScheduler(daemon=True)
 
-    app.thread_dict = {
-        'pupulate_ranking_data': Thread(target=rp.pupulate_ranking_data, daemon=True,
-                                        args=(ranking_topic, app.logger), name='pupulate_ranking_data')
-    }
+    app.thread_dict = dict()
+    if embedded_ingest:
+        app.thread_dict['pupulate_ranking_data'] = Thread(
+            target=rp.pupulate_ranking_data, daemon=True,
+            args=(ranking_topic, app.logger, ingest_batch_size, ingest_flush_interval_ms),
+            name='pupulate_ranking_data')
 
     # start worker threads
     for t in app.thread_dict.values():
@@ -85,12 +162,99 @@ def create_app():
             t.start()
 
     # start scheduler
-    app.scheduler.add_job(rp.clean_ranking_data, 'cron', hour='2', minute= '0', id='clean_ranking_data', args=[messages_lifespan, app.logger])
+    if embedded_ingest:
+        app.scheduler.add_job(rp.clean_ranking_data, 'interval', seconds=retention_interval, id='clean_ranking_data',
+                              args=[messages_lifespan, app.logger, retention_batch_size, retention_max_batches],
+                              max_instances=1, coalesce=True)
+        if snapshot_path:
+            app.scheduler.add_job(rp.write_snapshot, 'interval', seconds=snapshot_interval, id='write_snapshot',
+                                  args=[snapshot_path, app.logger], max_instances=1, coalesce=True)
+    else:
+        app.scheduler.add_job(rp.expire_cache, 'interval', seconds=retention_interval, id='expire_cache',
+                              args=[app.logger], max_instances=1, coalesce=True)
     app.scheduler.start()
 
     return app
 
 
+def run_ingester():
+    """
+    Runs the standalone ingester used with INGEST_MODE "external".
+
+    A single ingester process consumes the ranking topic and maintains the
+    shared database file, while the web workers only read from it.
+    """
+    app = create_app(ingester=True)
+    app.logger.info("orchestrator-kafka-proxy ingester is running")
+    app.thread_dict['pupulate_ranking_data'].join()
+
+
+def validate_retention_vacuum(vacuum):
+    """
+    Validates the vacuum mode of the retention job.
+    Parameters:
+    - vacuum (str): The vacuum mode to validate.
+    Raises:
+    - ValueError: If the vacuum mode is not one of ['none', 'incremental', 'full'].
+    """
+    valid_vacuum_modes = ["none", "incremental", "full"]
+    if vacuum not in valid_vacuum_modes:
+        raise ValueError(f"Invalid retention vacuum mode: {vacuum}. Valid vacuum modes are {valid_vacuum_modes}")
+
+
+def validate_db_compression(compression):
+    """
+    Validates the storage format of the rankings.
+    Parameters:
+    - compression (str): The compression to validate.
+    Raises:
+    - ValueError: If the compression is not one of ['none', 'zlib'].
+    """
+    valid_compressions = ["none", "zlib"]
+    if compression not in valid_compressions:
+        raise ValueError(f"Invalid database compression: {compression}. Valid compressions are {valid_compressions}")
+
+
+def validate_store_backend(backend, ingest_mode, mmap_path, snapshot_path):
+    """
+    Validates the storage backend and that it fits the ingest mode.
+    Parameters:
+    - backend (str): The storage backend to validate.
+    - ingest_mode (str): The ingest mode.
+    - mmap_path (str): The path of the files of the 'mmap' backend, if any.
+    - snapshot_path (str): The path of the snapshots, if any.
+    Raises:
+    - ValueError: If the backend is not one of ['sqlite', 'memory', 'mmap'], if the
+      'memory' backend is used with INGEST_MODE 'external' or snapshots, or if the
+      'mmap' backend is used without MMAP_STORE_PATH or with INGEST_MODE 'embedded'.
+    """
+    if backend not in VALID_STORE_BACKENDS:
+        raise ValueError(f"Invalid store backend: {backend}. Valid store backends are {VALID_STORE_BACKENDS}")
+    if backend == "memory" and (ingest_mode == "external" or snapshot_path):
+        raise ValueError("STORE_BACKEND 'memory' is private to each process: it needs INGEST_MODE 'embedded' "
+                         "and no SNAPSHOT_PATH")
+    if backend == "mmap" and (not mmap_path or ingest_mode != "external"):
+        raise ValueError("STORE_BACKEND 'mmap' needs MMAP_STORE_PATH and INGEST_MODE 'external', "
+                         "where a single ingester writes the files")
+
+
+def validate_ingest_mode(ingest_mode, db_connection):
+    """
+    Validates the ingest mode and that the database can be shared when needed.
+    Parameters:
+    - ingest_mode (str): The ingest mode to validate.
+    - db_connection (str): The database connection string.
+    Raises:
+    - ValueError: If the ingest mode is not one of ['embedded', 'external'] or if the
+      'external' mode is used with an in-memory database.
+    """
+    valid_ingest_modes = ["embedded", "external"]
+    if ingest_mode not in valid_ingest_modes:
+        raise ValueError(f"Invalid ingest mode: {ingest_mode}. Valid ingest modes are {valid_ingest_modes}")
+    if ingest_mode == "external" and ("mode=memory" in db_connection or db_connection == ":memory:"):
+        raise ValueError("INGEST_MODE 'external' needs DB_CONNECTION to be a database file shared by all processes")
+
+
 def validate_log_level(log_level):
     """
     Validates that the provided log level is a valid choice.
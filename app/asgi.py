@@ -0,0 +1,159 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import BadRequest, NotFound
+from app import create_app
+from app.lib import profiling
+from app.lib.utils import url_path_join
+import app.ranking_processor as rp
+from app.ranking_service import (
+    SSE_HEARTBEAT,
+    log_rank_timings,
+    sse_ranking_event,
+    sse_timeout_event,
+    validate_stream_ids,
+    warming_up_response,
+)
+
+
+class RankingASGIApp:
+    """
+    ASGI application serving POST /rank and GET /rank/stream natively on the
+    event loop.
+
+    A pending request awaits the ranking as an asyncio future resolved by the
+    consumer thread, so it costs memory only and no OS thread. Every other
+    route is delegated to the Flask application.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi_app = WsgiToAsgi(flask_app)
+        self.rank_path = url_path_join(flask_app.config.get("ROOT_PATH", "/cpr"), "rank")
+        self.stream_path = url_path_join(flask_app.config.get("ROOT_PATH", "/cpr"), "rank/stream")
+        self.query_timeout = float(flask_app.config.get("QUERY_TIMEOUT", 5))
+        self.stream_timeout = float(flask_app.config.get("RANK_STREAM_TIMEOUT", 300))
+        self.stream_heartbeat = float(flask_app.config.get("RANK_STREAM_HEARTBEAT", 15))
+        self.max_ids = int(flask_app.config.get("RANK_BATCH_MAX_IDS", 1000))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.rank_path:
+            await self._rank(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == self.stream_path:
+            await self._stream(scope, receive, send)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _rank(self, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        uuid = body.decode("utf-8")
+        self.flask_app.logger.info(f"Requested ranking for deployment id:{uuid}")
+        token = profiling.start_request()
+        profiling.profile_loop(asyncio.get_running_loop())
+        try:
+            status, headers, body = await self._rank_result(uuid)
+        finally:
+            timings = None if token is None else profiling.finish_request(token)
+        if timings is not None:
+            headers.append((b"server-timing", profiling.server_timing(timings).encode("latin-1")))
+            with self.flask_app.app_context():
+                log_rank_timings(uuid, status, timings)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _rank_result(self, uuid):
+        try:
+            ranking_data = await rp.get_ranking_data_async(uuid, self.query_timeout)
+        except rp.NotReadyError:
+            return self._response_result(warming_up_response())
+        if not rp.is_empty_ranking(ranking_data):
+            return 200, [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(ranking_data)).encode("latin-1")),
+            ], ranking_data
+        rp.rank_not_found.inc()
+        return self._response_result(NotFound().get_response())
+
+    async def _stream(self, scope, receive, send):
+        uuids = parse_qs(scope["query_string"].decode("latin-1")).get("id", [])
+        error = validate_stream_ids(uuids, self.max_ids)
+        if error:
+            await self._send_response(send, BadRequest(description=error).get_response())
+            return
+        self.flask_app.logger.info(f"Streaming ranking for deployment ids:{uuids}")
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        # stop watching as soon as the client goes away
+        stream = asyncio.ensure_future(self._send_stream(uuids, send))
+        disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+        await asyncio.wait({stream, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        for task in (stream, disconnect):
+            task.cancel()
+
+    async def _send_stream(self, uuids, send):
+        delivered = set()
+        async for item in rp.watch_ranking_data_async(uuids, self.stream_timeout, self.stream_heartbeat):
+            if item is None:
+                body = SSE_HEARTBEAT
+            else:
+                delivered.add(item[0])
+                body = sse_ranking_event(*item)
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+        missing = [uuid for uuid in dict.fromkeys(uuids) if uuid not in delivered]
+        await send({"type": "http.response.body", "body": sse_timeout_event(missing) if missing else b""})
+
+    async def _wait_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    def _response_result(self, response):
+        headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()]
+        return response.status_code, headers, response.get_data()
+
+    async def _send_response(self, send, response):
+        status, headers, body = self._response_result(response)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app():
+    return RankingASGIApp(create_app())
@@ -14,8 +14,9 @@
 
 import string
 import random
-import json
-from kafka import KafkaConsumer, KafkaProducer  # type: ignore
+import threading
+from kafka import KafkaConsumer, KafkaProducer, TopicPartition  # type: ignore
+from app.lib.codec import get_codec
 
 BOOTSTRAP_MSG_ERR: str = "Bootstrap_servers is not set"
 SYSLOG_TS_FORMAT = "%Y-%m-%dT%H:%M:%S%z"  # YYYY-MM-DDTHH:MM:SS+ZZ:ZZ
@@ -27,6 +28,25 @@ ssl_ca_path = None
 ssl_cert_path = None
 ssl_key_path = None
 ssl_password = None
+codec = get_codec()
+
+VALID_COMPRESSION_TYPES = [None, "gzip", "snappy", "lz4", "zstd"]
+
+# Tunables of every Kafka client built by this module
+client_options = {
+    "fetch_min_bytes": 1,
+    "fetch_max_wait_ms": 500,
+    "max_poll_records": 500,
+    "receive_buffer_bytes": None,
+    "compression_type": None,
+    "linger_ms": 5,
+    "batch_size": 16384,
+}
+
+# Long-lived producer shared by every thread, see get_producer()
+_producer = None
+_producer_lock = threading.Lock()
+
 
 def set_global_vars(
     *,
@@ -37,6 +57,7 @@ def set_global_vars(
     k_ssl_cert_path,
     k_ssl_key_path,
     k_ssl_password,
+    k_json_codec="auto",
 ):
     global db_connection
     db_connection = b_db_connection
@@ -52,54 +73,214 @@ def set_global_vars(
     ssl_key_path = k_ssl_key_path
     global ssl_password
     ssl_password = k_ssl_password
+    global codec
+    codec = get_codec(k_json_codec)
 
 
-# Write message in kafka topic
-def write_msg_to_kafka(data, topic):
-    global bootstrap_servers
-    if bootstrap_servers is None:
-        print(BOOTSTRAP_MSG_ERR)
-        return
+def set_client_options(
+    *,
+    fetch_min_bytes=1,
+    fetch_max_wait_ms=500,
+    max_poll_records=500,
+    receive_buffer_bytes=None,
+    compression_type=None,
+    linger_ms=5,
+    batch_size=16384,
+):
+    """
+    Set the options applied to every Kafka consumer and producer.
+    Args:
+        fetch_min_bytes (int): Minimum data returned by a fetch request.
+        fetch_max_wait_ms (int): Maximum time the broker waits to reach fetch_min_bytes.
+        max_poll_records (int): Maximum records returned by a single poll.
+        receive_buffer_bytes (int): Socket receive buffer size, None for the OS default.
+        compression_type (str): Producer compression, one of None, 'gzip', 'snappy', 'lz4' or 'zstd'.
+        linger_ms (int): Time the producer waits to fill a batch before sending it.
+        batch_size (int): Maximum size in bytes of a producer batch per partition.
+    Raises:
+        ValueError: If the compression type is not valid.
+    """
+    if compression_type in ("", "none"):
+        compression_type = None
+    if compression_type not in VALID_COMPRESSION_TYPES:
+        raise ValueError(f"Invalid Kafka compression type: {compression_type}. "
+                         f"Valid compression types are {VALID_COMPRESSION_TYPES}")
+    client_options["fetch_min_bytes"] = int(fetch_min_bytes)
+    client_options["fetch_max_wait_ms"] = int(fetch_max_wait_ms)
+    client_options["max_poll_records"] = int(max_poll_records)
+    client_options["receive_buffer_bytes"] = int(receive_buffer_bytes) if receive_buffer_bytes else None
+    client_options["compression_type"] = compression_type
+    client_options["linger_ms"] = int(linger_ms)
+    client_options["batch_size"] = int(batch_size)
+
+
+def _security_options():
+    if not ssl_enable:
+        return dict(security_protocol="PLAINTEXT")
+    return dict(
+        security_protocol="SSL",
+        ssl_check_hostname=False,
+        ssl_cafile=ssl_ca_path,
+        ssl_certfile=ssl_cert_path,
+        ssl_keyfile=ssl_key_path,
+        ssl_password=ssl_password,
+    )
 
-    producer = KafkaProducer(bootstrap_servers=bootstrap_servers,
-                             value_serializer=lambda x: json.dumps(x, sort_keys=True).encode('utf-8'))
-    if isinstance(data, list):
-        for msg in data:
-            producer.send(topic, msg)
-    else:
-        producer.send(topic, data)
-    producer.flush()
-    producer.close()
 
+def _random_group_id(group_base):
+    group_id = ''.join(random.choices(string.ascii_uppercase +
+                                      string.ascii_lowercase +
+                                      string.digits, k=64))
+    return f'{group_base}-{group_id}'
 
-def collect_all_msgs_from_topics(*topics):
-    global bootstrap_servers
+
+def _deserializer(deser_format):
+    def decode_str_func(x):
+        return x.decode('utf-8')
+
+    def decode_json_func(x):
+        return codec.loads(x)
+
+    if deser_format == 'json':
+        return decode_json_func
+    elif deser_format == 'bytes':
+        return None
+    else:
+        return decode_str_func
+
+
+def create_consumer(*topics, group_base=None, deser_format='str', **overrides):
+    """
+    Build a KafkaConsumer with the configured client and security options.
+    Args:
+        topics: Topics to subscribe to; none to assign partitions later.
+        group_base (str): Prefix of the random consumer group id, by default the topic names.
+        deser_format (str): 'str', 'json' or 'bytes' for the raw message value.
+        overrides: KafkaConsumer arguments replacing the configured ones.
+    Returns:
+        The consumer, or None when bootstrap_servers is not set.
+    """
     if bootstrap_servers is None:
         print(BOOTSTRAP_MSG_ERR)
         return
 
-    group_id = ''.join(random.choices(string.ascii_uppercase +
-                                      string.ascii_lowercase +
-                                      string.digits, k=64))
-    group_base = '-'.join(topics)
-    consumer = KafkaConsumer(
-        *topics,
+    options = dict(
         bootstrap_servers=bootstrap_servers,
-        group_id=f'{group_base}-{group_id}',
+        group_id=_random_group_id(group_base or '-'.join(topics)),
         auto_offset_reset='earliest',
         enable_auto_commit=True,
-        value_deserializer=lambda x: json.loads(x.decode('utf-8')),
+        value_deserializer=_deserializer(deser_format),
+        fetch_min_bytes=client_options["fetch_min_bytes"],
+        fetch_max_wait_ms=client_options["fetch_max_wait_ms"],
+        max_poll_records=client_options["max_poll_records"],
+        **_security_options(),
+    )
+    if client_options["receive_buffer_bytes"]:
+        options["receive_buffer_bytes"] = client_options["receive_buffer_bytes"]
+    options.update(overrides)
+    return KafkaConsumer(*topics, **options)
+
+
+def create_producer(**overrides):
+    """
+    Build a KafkaProducer serializing values with the JSON codec.
+    Args:
+        overrides: KafkaProducer arguments replacing the configured ones.
+    Returns:
+        The producer, or None when bootstrap_servers is not set.
+    """
+    if bootstrap_servers is None:
+        print(BOOTSTRAP_MSG_ERR)
+        return
+
+    options = dict(
+        bootstrap_servers=bootstrap_servers,
+        value_serializer=lambda x: codec.dumps(x, sort_keys=True),
+        compression_type=client_options["compression_type"],
+        linger_ms=client_options["linger_ms"],
+        batch_size=client_options["batch_size"],
+        **_security_options(),
+    )
+    if client_options["receive_buffer_bytes"]:
+        options["receive_buffer_bytes"] = client_options["receive_buffer_bytes"]
+    options.update(overrides)
+    return KafkaProducer(**options)
+
+
+def get_producer():
+    """
+    Return the producer shared by the whole process, creating it on first use.
+    KafkaProducer is thread-safe: records sent from any thread are batched
+    together on the same broker connections.
+    """
+    global _producer
+    if _producer is None:
+        with _producer_lock:
+            if _producer is None:
+                _producer = create_producer()
+    return _producer
+
+
+def close_producer(timeout=None):
+    """
+    Flush and close the shared producer; the next send creates a new one.
+    """
+    global _producer
+    with _producer_lock:
+        producer, _producer = _producer, None
+    if producer is not None:
+        producer.close(timeout=timeout)
+
+
+def send_msg(data, topic, key=None):
+    """
+    Queue a message for the topic without waiting for the broker.
+    Returns:
+        The FutureRecordMetadata of the message, or None when bootstrap_servers is not set.
+    """
+    producer = get_producer()
+    if producer is None:
+        return
+    return producer.send(topic, value=data, key=key)
+
+
+def send_msgs(messages, topic):
+    """
+    Queue every message for the topic without waiting for the broker.
+    Returns:
+        The list of FutureRecordMetadata, empty when bootstrap_servers is not set.
+    """
+    producer = get_producer()
+    if producer is None:
+        return list()
+    return [producer.send(topic, value=msg) for msg in messages]
+
+
+def flush_producer(timeout=None):
+    """
+    Wait until every queued message has been sent.
+    """
+    if _producer is not None:
+        _producer.flush(timeout=timeout)
+
+
+# Write message in kafka topic
+def write_msg_to_kafka(data, topic):
+    futures = send_msgs(data if isinstance(data, list) else [data], topic)
+    if futures:
+        flush_producer()
+
+
+def collect_all_msgs_from_topics(*topics):
+    consumer = create_consumer(
+        *topics,
+        deser_format='json',
         max_partition_fetch_bytes=100_000_000,
         fetch_max_bytes=50_000_000,
         consumer_timeout_ms=10000,
-        max_poll_records=1,
-        security_protocol="SSL",
-        ssl_check_hostname=False,
-        ssl_cafile=ssl_ca_path,
-        ssl_certfile=ssl_cert_path,
-        ssl_keyfile=ssl_key_path,
-        ssl_password=ssl_password,
     )
+    if consumer is None:
+        return
 
     collected_msgs = {topic: list() for topic in topics}
     for message in consumer:
@@ -109,32 +290,15 @@ def collect_all_msgs_from_topics(*topics):
 
 
 def collect_all_msgs_from_topic(topic):
-    global bootstrap_servers
-    if bootstrap_servers is None:
-        print(BOOTSTRAP_MSG_ERR)
-        return
-
-    group_id = ''.join(random.choices(string.ascii_uppercase +
-                                      string.ascii_lowercase +
-                                      string.digits, k=64))
-    consumer = KafkaConsumer(
+    consumer = create_consumer(
         topic,
-        bootstrap_servers=bootstrap_servers,
-        group_id=f'{topic}-{group_id}',
-        auto_offset_reset='earliest',
-        enable_auto_commit=True,
-        value_deserializer=lambda x: json.loads(x.decode('utf-8')),
+        deser_format='json',
         max_partition_fetch_bytes=100_000_000,
         fetch_max_bytes=50_000_000,
         consumer_timeout_ms=10000,
-        max_poll_records=1,
-        security_protocol="SSL",
-        ssl_check_hostname=False,
-        ssl_cafile=ssl_ca_path,
-        ssl_certfile=ssl_cert_path,
-        ssl_keyfile=ssl_key_path,
-        ssl_password=ssl_password,
     )
+    if consumer is None:
+        return
 
     collected_msgs = list()
     for message in consumer:
@@ -143,112 +307,54 @@ def collect_all_msgs_from_topic(topic):
 
 
 def get_topics_consumer_obj(*topics, deser_format='str'):
-    global bootstrap_servers
-    if bootstrap_servers is None:
-        print(BOOTSTRAP_MSG_ERR)
-        return
-
-    def derserializer(deser_format):
-        def decode_str_func(x):
-            return x.decode('utf-8')
+    return create_consumer(*topics, deser_format=deser_format)
 
-        def decode_json_func(x):
-            return json.loads(x.decode('utf-8'))
 
-        if deser_format == 'json':
-            return decode_json_func
-        else:
-            return decode_str_func
+def get_topic_consumer_obj(topic, deser_format='str', max_poll_records=None, start_offsets=None):
+    overrides = dict()
+    if max_poll_records is not None:
+        overrides["max_poll_records"] = max_poll_records
+    consumer = create_consumer(group_base=topic, deser_format=deser_format, **overrides)
+    if consumer is None:
+        return
 
-    deser_func = derserializer(deser_format)
-    group_base = '-'.join(topics)
-    group_id = ''.join(random.choices(string.ascii_uppercase +
-                                      string.ascii_lowercase +
-                                      string.digits, k=64))
-    consumer = KafkaConsumer(
-        *topics,
-        bootstrap_servers=bootstrap_servers,
-        group_id=f'{group_base}-{group_id}',
-        auto_offset_reset='earliest',
-        enable_auto_commit=True,
-        value_deserializer=deser_func,
-        max_poll_records=1,
-        security_protocol="SSL",
-        ssl_check_hostname=False,
-        ssl_cafile=ssl_ca_path,
-        ssl_certfile=ssl_cert_path,
-        ssl_keyfile=ssl_key_path,
-        ssl_password=ssl_password,
-    )
+    if start_offsets:
+        # resume from the given {partition: next offset} map instead of joining a group;
+        # partitions without a stored offset are read from the beginning
+        partitions = [TopicPartition(topic, p) for p in sorted(consumer.partitions_for_topic(topic) or [])]
+        consumer.assign(partitions)
+        for tp in partitions:
+            if tp.partition in start_offsets:
+                consumer.seek(tp, start_offsets[tp.partition])
+            else:
+                consumer.seek_to_beginning(tp)
+    else:
+        consumer.subscribe([topic])
 
     return consumer
 
 
-def get_topic_consumer_obj(topic, deser_format='str'):
-    global bootstrap_servers
-    if bootstrap_servers is None:
-        print(BOOTSTRAP_MSG_ERR)
-        return
+def get_end_offsets(consumer, topic):
+    """
+    Return the {partition: end offset} map of the topic, the offset the next
+    message of each partition will get.
+    """
+    partitions = [TopicPartition(topic, p) for p in sorted(consumer.partitions_for_topic(topic) or [])]
+    if not partitions:
+        return dict()
+    return {tp.partition: end for tp, end in consumer.end_offsets(partitions).items()}
 
-    def derserializer(deser_format):
-        def decode_str_func(x):
-            return x.decode('utf-8')
 
-        def decode_json_func(x):
-            return json.loads(x.decode('utf-8'))
-
-        if deser_format == 'json':
-            return decode_json_func
-        else:
-            return decode_str_func
-
-    deser_func = derserializer(deser_format)
-    group_id = ''.join(random.choices(string.ascii_uppercase +
-                                      string.ascii_lowercase +
-                                      string.digits, k=64))
-    consumer = KafkaConsumer(
-        topic,
-        bootstrap_servers=bootstrap_servers,
-        group_id=f'{topic}-{group_id}',
-        auto_offset_reset='earliest',
-        enable_auto_commit=True,
-        value_deserializer=deser_func,
-        max_poll_records=1,
-        security_protocol="SSL",
-        ssl_check_hostname=False,
-        ssl_cafile=ssl_ca_path,
-        ssl_certfile=ssl_cert_path,
-        ssl_keyfile=ssl_key_path,
-        ssl_password=ssl_password,
-    )
-
-    return consumer
+def get_beginning_offsets(consumer, topic):
+    """
+    Return the {partition: beginning offset} map of the topic, the offset of
+    the oldest message retained in each partition.
+    """
+    partitions = [TopicPartition(topic, p) for p in sorted(consumer.partitions_for_topic(topic) or [])]
+    if not partitions:
+        return dict()
+    return {tp.partition: start for tp, start in consumer.beginning_offsets(partitions).items()}
 
 
 def get_consumer_obj_str(*topics):
-    global bootstrap_servers
-    if bootstrap_servers is None:
-        print(BOOTSTRAP_MSG_ERR)
-        return
-
-    group_base = '-'.join(topics)
-    group_id = ''.join(random.choices(string.ascii_uppercase +
-                                      string.ascii_lowercase +
-                                      string.digits, k=64))
-    consumer = KafkaConsumer(
-        *topics,
-        bootstrap_servers=bootstrap_servers,
-        group_id=f'{group_base}-{group_id}',
-        auto_offset_reset='earliest',
-        enable_auto_commit=True,
-        value_deserializer=lambda x: x.decode("utf-8"),
-        max_poll_records=1,
-        security_protocol="SSL",
-        ssl_check_hostname=False,
-        ssl_cafile=ssl_ca_path,
-        ssl_certfile=ssl_cert_path,
-        ssl_keyfile=ssl_key_path,
-        ssl_password=ssl_password,
-    )
-
-    return consumer
+    return create_consumer(*topics, deser_format='str')
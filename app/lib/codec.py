@@ -0,0 +1,125 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec  # type: ignore
+except ImportError:
+    msgspec = None
+
+
+class JsonCodec:
+    """
+    JSON codec based on the standard library json module.
+    Every codec decodes from and encodes to UTF-8 bytes.
+    """
+
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, sort_keys=False, default=None):
+        return json.dumps(obj, sort_keys=sort_keys, default=default, separators=(",", ":")).encode("utf-8")
+
+
+class OrjsonCodec:
+    """
+    JSON codec based on orjson.
+    """
+
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj, sort_keys=False, default=None):
+        return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+
+class MsgspecCodec:
+    """
+    JSON codec based on msgspec.
+    """
+
+    name = "msgspec"
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+        self._sorted_encoder = msgspec.json.Encoder(order="sorted")
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+    def dumps(self, obj, sort_keys=False, default=None):
+        if default is not None:
+            return msgspec.json.encode(obj, enc_hook=default, order="sorted" if sort_keys else None)
+        return (self._sorted_encoder if sort_keys else self._encoder).encode(obj)
+
+
+CODECS = {
+    "orjson": (OrjsonCodec, lambda: orjson is not None),
+    "msgspec": (MsgspecCodec, lambda: msgspec is not None),
+    "json": (JsonCodec, lambda: True),
+}
+
+
+def get_codec(name="auto"):
+    """
+    Return the JSON codec with the given name.
+    Args:
+        name (str): One of 'auto', 'orjson', 'msgspec' or 'json'. 'auto' selects
+                    the first installed among orjson, msgspec and json.
+    Returns:
+        The codec instance.
+    Raises:
+        ValueError: If the codec is unknown or its library is not installed.
+    """
+    if name == "auto":
+        for codec_class, available in CODECS.values():
+            if available():
+                return codec_class()
+    if name not in CODECS:
+        raise ValueError(f"Invalid JSON codec: {name}. Valid JSON codecs are {['auto'] + list(CODECS)}")
+    codec_class, available = CODECS[name]
+    if not available():
+        raise ValueError(f"JSON codec '{name}' is not installed")
+    return codec_class()
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider serializing responses with the configured codec.
+    Indented output, used in debug mode, is left to the standard library.
+    """
+
+    codec = JsonCodec()
+
+    def dumps(self, obj, **kwargs):
+        if self.codec.name == "json" or "indent" in kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.codec.dumps(obj, sort_keys=self.sort_keys, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if self.codec.name == "json":
+            return super().loads(s, **kwargs)
+        return self.codec.loads(s)
@@ -0,0 +1,73 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact storage of the ranked_providers payloads.
+
+A payload is deflated with a preset dictionary holding the provider key names
+in the layouts the AI-Ranker and the JSON codecs produce, so even a single
+provider compresses well. Compressed values start with a format marker that
+JSON text never starts with; anything else is returned unchanged, so rows
+stored before compression was enabled are still served as they are.
+"""
+
+import zlib
+
+# Provider keys in the order the AI-Ranker publishes them
+RANKING_KEYS = (
+    "classification", "regression", "resource_exactness", "bandwidth_in", "bandwidth_out", "exact_flavors",
+    "floating_ips_quota", "floating_ips_requ", "floating_ips_usage", "gpus_requ", "n_instances_quota",
+    "n_instances_requ", "n_instances_usage", "n_volumes_quota", "n_volumes_requ", "n_volumes_usage",
+    "overbooking_cpu", "overbooking_ram", "provider_name", "ram_gb_quota", "ram_gb_requ", "ram_gb_usage",
+    "region_name", "storage_gb_quota", "storage_gb_requ", "storage_gb_usage", "test_failure_perc_1d",
+    "test_failure_perc_30d", "test_failure_perc_7d", "vcpus_quota", "vcpus_requ", "vcpus_usage",
+)
+
+
+def _build_zdict(keys):
+    pieces = list()
+    for item_separator, key_separator in ((",", ":"), (", ", ": ")):
+        for ordered_keys in (sorted(keys), keys):
+            pieces.append("{" + item_separator.join(f'"{k}"{key_separator}' for k in ordered_keys) + "}")
+    return "".join(pieces).encode("utf-8")
+
+
+# Stored blobs can only be inflated with the dictionary they were deflated with:
+# never change it, add a new format version instead
+ZDICT_V1 = _build_zdict(RANKING_KEYS)
+ZLIB_V1_MARKER = b"\x00z1"
+
+_WBITS = -15  # raw deflate stream, the marker already identifies the format
+
+
+def is_compressed(value):
+    return value[:len(ZLIB_V1_MARKER)] == ZLIB_V1_MARKER
+
+
+def compress(data, level=6):
+    """
+    Return the compact form of the JSON bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS, 9, zlib.Z_DEFAULT_STRATEGY, ZDICT_V1)
+    return ZLIB_V1_MARKER + compressor.compress(data) + compressor.flush()
+
+
+def decompress(value):
+    """
+    Return the exact JSON bytes of a stored value, compressed or not.
+    """
+    if not is_compressed(value):
+        return value
+    decompressor = zlib.decompressobj(_WBITS, ZDICT_V1)
+    return decompressor.decompress(value[len(ZLIB_V1_MARKER):]) + decompressor.flush()
@@ -0,0 +1,99 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQLite connection management for the ranking database.
+
+connect() opens a tuned connection, get_connection() returns one owned by the
+calling thread and reused across calls, so request threads, the scheduler and
+the event loop do not pay the connect and teardown cost on every query. The
+statements run on a connection are compiled once and kept in its statement
+cache.
+"""
+
+import sqlite3
+import threading
+import app.kafka_interface as ki
+from app.lib import profiling
+
+VALID_SYNCHRONOUS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+# Compiled statements kept by each connection
+CACHED_STATEMENTS = 64
+
+pragmas = {
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -16384,
+    "synchronous": "NORMAL",
+}
+
+_local = threading.local()
+# SQLite has a single writer: batch stores, retention and snapshots take turns
+write_lock = threading.RLock()
+
+
+def configure(mmap_size=64 * 1024 * 1024, cache_size_kb=16384, synchronous="NORMAL"):
+    """
+    Set the PRAGMAs applied to every new connection.
+    Args:
+        mmap_size (int): Bytes of the database file accessed through memory mapping.
+        cache_size_kb (int): Page cache size of each connection, in KiB.
+        synchronous (str): One of 'OFF', 'NORMAL', 'FULL' or 'EXTRA'.
+    Raises:
+        ValueError: If the synchronous mode is not valid.
+    """
+    synchronous = str(synchronous).upper()
+    if synchronous not in VALID_SYNCHRONOUS:
+        raise ValueError(f"Invalid synchronous mode: {synchronous}. Valid modes are {VALID_SYNCHRONOUS}")
+    pragmas["mmap_size"] = int(mmap_size)
+    pragmas["cache_size"] = -int(cache_size_kb)
+    pragmas["synchronous"] = synchronous
+
+
+def connect():
+    """
+    Open a new tuned connection to the ranking database; the caller closes it.
+    """
+    conn = sqlite3.connect(ki.db_connection, timeout=5, cached_statements=CACHED_STATEMENTS)
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value};")
+    # with the shared-cache in-memory database, readers would otherwise fail with
+    # "database table is locked" while the consumer commits a batch; no effect on files
+    conn.execute("PRAGMA read_uncommitted=1;")
+    return conn
+
+
+def get_connection():
+    """
+    Return the connection of the calling thread, opening it on first use.
+    It must not be closed by the caller.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.target != ki.db_connection:
+        if conn is not None:
+            conn.close()
+        with profiling.phase("connect"):
+            conn = _local.conn = connect()
+        _local.target = ki.db_connection
+    return conn
+
+
+def close_connection():
+    """
+    Close the connection of the calling thread, if any.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
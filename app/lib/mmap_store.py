@@ -0,0 +1,384 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append-only ranking store memory mapped by several processes.
+
+The ingester appends every ranking to <path>.data and publishes its offset in
+<path>.index, an open addressing hash table keyed by a 64-bit hash of the
+uuid. Web workers map both files read-only: a lookup is a hash probe plus a
+slice of the data file, served from the page cache shared by all processes.
+
+<path>.data   records: MAGIC u32, uuid length u16, value length u32, ts i64, uuid, value
+<path>.index  header: MAGIC, capacity, count, data end, stale, min ts; slots: uuid hash u64, offset u64
+
+A record is written before its slot, and a slot gets its offset before its
+hash, so readers never follow a slot to unwritten data. The index is rebuilt
+into a new file when it grows or when the data file is compacted; the old one
+is then flagged stale and readers reopen both files. Records older than the
+min ts of the header were expired by the retention job and are not served,
+even before compaction drops them.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+RECORD_MAGIC = 0x4F4B5052
+INDEX_MAGIC = b"OKPIDX02"
+RECORD = struct.Struct("<IHIq")
+HEADER = struct.Struct("<8sQQQQq")
+SLOT = struct.Struct("<QQ")
+MAX_LOAD = 0.5
+
+
+def uuid_hash(uuid):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(uuid, digest_size=8).digest(), "little") or 1
+
+
+def _encode_record(uuid, ts, value):
+    return RECORD.pack(RECORD_MAGIC, len(uuid), len(value), ts) + uuid + value
+
+
+def _new_index(path, capacity, count, data_end, min_ts=0):
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(INDEX_MAGIC, capacity, count, data_end, 0, min_ts))
+        f.truncate(HEADER.size + capacity * SLOT.size)
+
+
+class _Index:
+    """
+    Memory-mapped hash table of the uuid offsets.
+    """
+
+    def __init__(self, path, writable=False):
+        self._file = open(path, "r+b" if writable else "rb")
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, self.capacity = HEADER.unpack_from(self.map, 0)[:2]
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a ranking index")
+        self.mask = self.capacity - 1
+
+    def header(self):
+        return HEADER.unpack_from(self.map, 0)
+
+    def set_header(self, count, data_end, min_ts, stale=0):
+        HEADER.pack_into(self.map, 0, INDEX_MAGIC, self.capacity, count, data_end, stale, min_ts)
+
+    def slots(self, h):
+        """
+        Yield (slot position, slot hash, offset) along the probe sequence of h,
+        up to the first empty slot.
+        """
+        i = h & self.mask
+        for _ in range(self.capacity):
+            position = HEADER.size + i * SLOT.size
+            slot_hash, offset = SLOT.unpack_from(self.map, position)
+            yield position, slot_hash, offset
+            if slot_hash == 0:
+                return
+            i = (i + 1) & self.mask
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+        self._file.close()
+
+
+class MmapStoreWriter:
+    """
+    Single writer of the store, used by the ingester.
+    """
+
+    def __init__(self, path, initial_capacity=1 << 16):
+        self.path = path
+        self.data_path = f"{path}.data"
+        self.index_path = f"{path}.index"
+        self.initial_capacity = initial_capacity
+        self.dead = 0
+        try:
+            self.index = _Index(self.index_path, writable=True)
+            if not os.path.exists(self.data_path):
+                self.index.close()
+                raise FileNotFoundError(self.data_path)
+        except (OSError, ValueError):
+            # missing, or written by a previous version of the format
+            open(self.data_path, "wb").close()
+            _new_index(self.index_path, initial_capacity, 0, 0)
+            self.index = _Index(self.index_path, writable=True)
+        _, _, self.count, self.data_end, _, self.min_ts = self.index.header()
+        self._data = open(self.data_path, "r+b")
+        # drop a record appended without being indexed before a crash
+        self._data.truncate(self.data_end)
+        self._data.seek(self.data_end)
+
+    def _read_record(self, offset):
+        magic, uuid_length, value_length, ts = RECORD.unpack(os.pread(self._data.fileno(), RECORD.size, offset))
+        return ts, RECORD.size + uuid_length + value_length
+
+    def _find(self, h, uuid):
+        for position, slot_hash, offset in self.index.slots(h):
+            if slot_hash == 0:
+                return position, None
+            if slot_hash == h:
+                header = os.pread(self._data.fileno(), RECORD.size, offset)
+                uuid_length = RECORD.unpack(header)[1]
+                if os.pread(self._data.fileno(), uuid_length, offset + RECORD.size) == uuid:
+                    return position, offset
+        raise RuntimeError("ranking index is full")
+
+    def put_many(self, rows):
+        """
+        Store the (uuid, ts, value bytes) rows; an older ts never replaces a newer one.
+        """
+        latest = dict()
+        for uuid, ts, value in rows:
+            uuid = uuid.encode("utf-8")
+            if uuid not in latest or latest[uuid][0] <= ts:
+                latest[uuid] = (ts, value)
+        capacity = self.index.capacity
+        while self.count + len(latest) > capacity * MAX_LOAD:
+            capacity *= 2
+        if capacity != self.index.capacity:
+            self._rebuild(capacity)
+        appended = bytearray()
+        updates = list()
+        for uuid, (ts, value) in latest.items():
+            h = uuid_hash(uuid)
+            _, offset = self._find(h, uuid)
+            if offset is not None:
+                if self._read_record(offset)[0] > ts:
+                    continue
+                self.dead += 1
+            updates.append((h, uuid, self.data_end + len(appended)))
+            appended += _encode_record(uuid, ts, value)
+        if not updates:
+            return
+        self._data.write(appended)
+        self._data.flush()
+        for h, uuid, new_offset in updates:
+            position, offset = self._find(h, uuid)
+            # offset before hash: a reader matching the hash always finds the record
+            struct.pack_into("<Q", self.index.map, position + 8, new_offset)
+            struct.pack_into("<Q", self.index.map, position, h)
+            self.count += offset is None
+        self.data_end += len(appended)
+        self.index.set_header(self.count, self.data_end, self.min_ts)
+
+    def _live_records(self, cutoff=None):
+        with open(self.data_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.data_end else b""
+            try:
+                for position in range(HEADER.size, len(self.index.map), SLOT.size):
+                    slot_hash, offset = SLOT.unpack_from(self.index.map, position)
+                    if slot_hash == 0:
+                        continue
+                    _, uuid_length, value_length, ts = RECORD.unpack_from(data, offset)
+                    if cutoff is None or ts >= cutoff:
+                        yield slot_hash, offset, RECORD.size + uuid_length + value_length, ts, data
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    def _swap(self, capacity, count, data_end, fill):
+        tmp_index = f"{self.index_path}.tmp"
+        _new_index(tmp_index, capacity, count, data_end, self.min_ts)
+        new_index = _Index(tmp_index, writable=True)
+        fill(new_index)
+        new_index.map.flush()
+        os.replace(tmp_index, self.index_path)
+        # readers still on the old files reopen them
+        self.index.set_header(self.count, self.data_end, self.min_ts, stale=1)
+        self.index.close()
+        self.index = new_index
+        self.count = count
+        self.data_end = data_end
+
+    @staticmethod
+    def _insert(index, h, offset):
+        for position, slot_hash, _ in index.slots(h):
+            if slot_hash == 0:
+                SLOT.pack_into(index.map, position, h, offset)
+                return
+
+    def _rebuild(self, capacity):
+        slots = [(h, offset) for h, offset, _, _, _ in self._live_records()]
+
+        def fill(index):
+            for h, offset in slots:
+                self._insert(index, h, offset)
+
+        self._swap(capacity, self.count, self.data_end, fill)
+
+    def compact(self, cutoff=None):
+        """
+        Rewrite the data file without the replaced records and, when cutoff is
+        given, without the ones older than it. Returns the removed records.
+        """
+        tmp_data = f"{self.data_path}.tmp"
+        slots = list()
+        with open(tmp_data, "wb") as out:
+            data_end = 0
+            for h, offset, size, _, data in self._live_records(cutoff):
+                out.write(data[offset:offset + size])
+                slots.append((h, data_end))
+                data_end += size
+        removed = self.count - len(slots)
+        self._replace_data(tmp_data, slots, data_end)
+        return removed
+
+    def clear(self):
+        """
+        Remove every record.
+        """
+        tmp_data = f"{self.data_path}.tmp"
+        open(tmp_data, "wb").close()
+        self.min_ts = 0
+        self._replace_data(tmp_data, [], 0)
+
+    def _replace_data(self, tmp_data, slots, data_end):
+        capacity = self.initial_capacity
+        while len(slots) > capacity * MAX_LOAD:
+            capacity *= 2
+
+        def fill(index):
+            for h, offset in slots:
+                self._insert(index, h, offset)
+            # the new data must be in place before the index pointing into it
+            os.replace(tmp_data, self.data_path)
+
+        self._data.close()
+        self._swap(capacity, len(slots), data_end, fill)
+        self._data = open(self.data_path, "r+b")
+        self._data.seek(self.data_end)
+        self.dead = 0
+
+    def expire_before(self, cutoff):
+        """
+        Stop serving the records older than cutoff at once; they take space
+        until the next compaction.
+        """
+        if cutoff > self.min_ts:
+            self.min_ts = cutoff
+            self.index.set_header(self.count, self.data_end, self.min_ts)
+
+    def maybe_compact(self, cutoff, expired):
+        """
+        Compact once replaced or expired records are as many as the live ones.
+        """
+        if self.dead + expired > self.count - expired:
+            return self.compact(cutoff)
+        self.dead += expired
+        return 0
+
+    def stats(self):
+        return {"count": self.count, "capacity": self.index.capacity, "data_bytes": self.data_end,
+                "dead": self.dead}
+
+    def close(self):
+        self.index.close()
+        self._data.close()
+
+
+class MmapStoreReader:
+    """
+    Read-only view of the store, used by the web workers.
+    """
+
+    def __init__(self, path):
+        self.index_path = f"{path}.index"
+        self.data_path = f"{path}.data"
+        self.index = None
+        self._data_file = None
+        self._data = None
+
+    def _open(self):
+        self.close()
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            self.index = _Index(self.index_path)
+        except ValueError:
+            # written by a previous version of the format, until the ingester replaces it
+            return False
+        self._data_file = open(self.data_path, "rb")
+        self._data = None
+        return True
+
+    def _data_map(self, end):
+        if self._data is None or len(self._data) < end:
+            # the file grew: map it again through the same descriptor, the one the index points into
+            if self._data is not None:
+                self._data.close()
+            self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    def _current_index(self):
+        if self.index is None or self.index.header()[4]:
+            if not self._open():
+                return None
+        return self.index
+
+    def version(self):
+        """
+        Value changing every time the ingester stores rankings.
+        """
+        index = self._current_index()
+        if index is None:
+            return None
+        return id(index), index.header()[3]
+
+    def get(self, uuid):
+        """
+        Return (ts, value bytes) of the uuid, or None.
+        """
+        index = self._current_index()
+        if index is None:
+            return None
+        uuid = uuid.encode("utf-8")
+        h = uuid_hash(uuid)
+        for _, slot_hash, offset in index.slots(h):
+            if slot_hash == 0:
+                return None
+            if slot_hash != h:
+                continue
+            data = self._data_map(offset + RECORD.size)
+            if offset + RECORD.size > len(data):
+                # index and data file of different generations, opened while being swapped
+                return None
+            magic, uuid_length, value_length, ts = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            if magic != RECORD_MAGIC:
+                return None
+            data = self._data_map(start + uuid_length + value_length)
+            if data[start:start + uuid_length] == uuid:
+                if ts < index.header()[5]:
+                    # expired by the retention job, not compacted yet
+                    return None
+                return ts, data[start + uuid_length:start + uuid_length + value_length]
+        return None
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        if self._data_file is not None:
+            self._data_file.close()
+            self._data_file = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
@@ -0,0 +1,253 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in profiling of the /rank hot path.
+
+When enabled, a /rank request records the time spent in each phase (cache
+lookup, database connection, store read, wait for the consumer, response)
+in a context variable. asyncio copies it into the tasks a request starts,
+so concurrent requests on the event loop keep their own timings; work done
+for the request by other threads, like the consumer storing the ranking,
+only shows as time waited. The timings are returned in the Server-Timing
+header and logged for a sample of the requests. start_profile() runs the
+profiles of the /admin/profile endpoint in the background.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+enabled = False
+log_sample_rate = 0.01
+
+_timings = contextvars.ContextVar("okp_timings", default=None)
+_no_phase = contextlib.nullcontext()
+
+# cProfile of the /rank requests served while a profile is running
+_profile_lock = threading.Lock()
+_profile_until = 0.0
+_profiles = list()
+_profiled_requests = 0
+_profiled_loops = set()
+_profiles_lock = threading.Lock()
+# (mode, seconds, report) of the last profile, report None while it runs
+_last_profile = None
+
+def configure(enable, sample_rate=0.01):
+    global enabled
+    global log_sample_rate
+    enabled = bool(enable)
+    log_sample_rate = float(sample_rate)
+
+
+class _Phase:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+def start_request():
+    """
+    Start recording the phases of the current request.
+    Returns the token to pass to finish_request, or None when disabled.
+    """
+    if not enabled:
+        return None
+    return _timings.set({"start": time.perf_counter()})
+
+
+def phase(name):
+    """
+    Context manager adding the time spent in it to the phase of the current
+    request; it does nothing outside a recorded request.
+    """
+    timings = _timings.get()
+    if timings is None:
+        return _no_phase
+    return _Phase(timings, name)
+
+
+def finish_request(token):
+    """
+    Stop recording and return {phase: seconds}, including the total.
+    """
+    timings = _timings.get()
+    _timings.reset(token)
+    timings["total"] = time.perf_counter() - timings.pop("start")
+    return timings
+
+
+def server_timing(timings):
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items())
+
+
+def should_log():
+    return random.random() < log_sample_rate
+
+
+def format_timings(timings):
+    return " ".join(f"{name}={seconds * 1000:.3f}ms" for name, seconds in timings.items())
+
+
+def run_profiled(func, *args):
+    """
+    Call func, under cProfile when a profile of the requests is running.
+    """
+    global _profiled_requests
+    if time.monotonic() >= _profile_until:
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        with _profiles_lock:
+            _profiles.append(profile)
+            _profiled_requests += 1
+
+
+def profile_loop(loop):
+    """
+    Profile with cProfile the thread of the event loop, called by the ASGI
+    /rank requests, until the running profile ends. The coroutines of the
+    requests interleave on the loop, so it is profiled as a whole instead of
+    one call at a time like in run_profiled.
+    """
+    global _profiled_requests
+    remaining = _profile_until - time.monotonic()
+    if remaining <= 0:
+        return
+    with _profiles_lock:
+        _profiled_requests += 1
+        if loop in _profiled_loops:
+            return
+        _profiled_loops.add(loop)
+    profile = cProfile.Profile()
+    profile.enable()
+
+    def stop():
+        profile.disable()
+        with _profiles_lock:
+            _profiles.append(profile)
+            _profiled_loops.discard(loop)
+
+    loop.call_later(remaining, stop)
+
+
+def profile_requests(seconds, limit=40):
+    """
+    Profile with cProfile the /rank requests for the given seconds and
+    return the statistics of the slowest functions, as text.
+    """
+    global _profile_until
+    global _profiled_requests
+    _profile_until = time.monotonic() + seconds
+    time.sleep(seconds)
+    _profile_until = 0.0
+    # the event loops stop their profiles on their own thread
+    deadline = time.monotonic() + 1
+    while _profiled_loops and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with _profiles_lock:
+        profiles = list(_profiles)
+        requests = _profiled_requests
+        _profiles.clear()
+        _profiled_requests = 0
+    if not profiles:
+        return f"No profiled request in {seconds}s\n"
+    out = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=out)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    out.write(f"{requests} requests profiled in {seconds}s\n")
+    stats.sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def sample_stacks(seconds, interval=0.005):
+    """
+    Sample the stacks of every thread but the calling one for the given
+    seconds and return them in the collapsed format of flame graphs, one
+    "thread;outer;...;inner count" line per stack, most frequent first.
+    """
+    samples = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def _run_profile(mode, seconds):
+    global _last_profile
+    try:
+        if mode == "cprofile":
+            report = profile_requests(seconds)
+        else:
+            report = sample_stacks(seconds)
+    except Exception as e:
+        report = f"Profile failed: {e!r}\n"
+    try:
+        _last_profile = (mode, seconds, report)
+    finally:
+        _profile_lock.release()
+
+
+def start_profile(mode, seconds):
+    """
+    Start a profile of the given seconds in a background thread, so the
+    thread serving the request is not held: 'cprofile' profiles the /rank
+    requests, 'stack' samples the stacks of every thread.
+    Raises:
+        ValueError: If a profile is already running.
+    """
+    global _last_profile
+    if not _profile_lock.acquire(blocking=False):
+        raise ValueError("A profile is already running")
+    _last_profile = (mode, seconds, None)
+    threading.Thread(target=_run_profile, args=(mode, seconds), daemon=True, name="profiler").start()
+
+
+def get_profile():
+    """
+    Return (mode, seconds, report) of the last profile, with report None
+    while it runs, or None if no profile was started.
+    """
+    return _last_profile
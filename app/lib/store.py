@@ -0,0 +1,398 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Storage backends of the rankings.
+
+Every backend keeps, for each deployment uuid, the Kafka timestamp and the
+JSON bytes of its most recent ranking, together with the next Kafka offset to
+read for each partition, which is saved with the rankings it follows.
+
+- sqlite: the ranking_data table of the database in DB_CONNECTION.
+- memory: a dict in the process memory, for a single process.
+- mmap: the sqlite backend, plus the files of app.lib.mmap_store the web
+  workers read the rankings from.
+"""
+
+import threading
+import time
+from app.lib import compact
+from app.lib import db
+from app.lib import mmap_store
+
+VALID_STORE_BACKENDS = ["sqlite", "memory", "mmap"]
+
+# Duplicate deliveries and re-rankings of a deployment keep the newest message
+UPSERT_RANKING = (
+    "INSERT INTO ranking_data (uuid, ts, rank) VALUES (?, ?, ?) "
+    "ON CONFLICT(uuid) DO UPDATE SET ts=excluded.ts, rank=excluded.rank "
+    "WHERE excluded.ts >= ranking_data.ts;"
+)
+UPSERT_OFFSET = (
+    "INSERT INTO kafka_offsets (topic, partition_id, next_offset) VALUES (?, ?, ?) "
+    "ON CONFLICT(topic, partition_id) DO UPDATE SET next_offset=excluded.next_offset;"
+)
+# Uuids stored by the ingester, for the caches of the web workers to drop
+INSERT_CHANGE = "INSERT INTO ranking_changes (uuid) VALUES (?);"
+TRIM_CHANGES = "DELETE FROM ranking_changes WHERE seq <= (SELECT MAX(seq) FROM ranking_changes) - ?;"
+# Changes kept for the web workers that check them late
+CHANGES_KEPT = 100000
+DELETE_EXPIRED_BATCH = (
+    "DELETE FROM ranking_data WHERE rowid IN "
+    "(SELECT rowid FROM ranking_data WHERE ts < ? LIMIT ?);"
+)
+# Bound on the host parameters of a single IN (...) query
+QUERY_CHUNK_SIZE = 500
+
+
+class RankingStore:
+    """
+    Interface of the storage backends.
+    """
+
+    name = None
+
+    def put_many(self, rows, offsets=()):
+        """
+        Store the (uuid, ts, ranking bytes) rows, keeping the newest ranking of
+        each uuid, and the (topic, partition, next offset) of the partitions
+        they were read from.
+        """
+        raise NotImplementedError
+
+    def load_offsets(self, topic):
+        """
+        Return {partition: next offset} saved for the topic.
+        """
+        raise NotImplementedError
+
+    def get(self, uuid):
+        """
+        Return (ts, ranking bytes) of the uuid, or None.
+        """
+        raise NotImplementedError
+
+    def get_many(self, uuids):
+        """
+        Return {uuid: (ts, ranking bytes)} of the uuids that have a ranking.
+        """
+        found = dict()
+        for uuid in uuids:
+            ranking = self.get(uuid)
+            if ranking is not None:
+                found[uuid] = ranking
+        return found
+
+    def version(self):
+        """
+        Return a value changing every time rankings are stored, by any process.
+        """
+        raise NotImplementedError
+
+    def changes_since(self, seq):
+        """
+        Return the last change of the stored rankings and the uuids stored
+        after change seq, or None instead of the uuids when seq is None or the
+        changes since seq are no longer all recorded.
+        """
+        raise NotImplementedError
+
+    def wait_for(self, version, timeout):
+        """
+        Block until the version differs from the given one or timeout
+        expires, and return the current version.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.version()
+            remaining = deadline - time.monotonic()
+            if current != version or remaining <= 0:
+                return current
+            time.sleep(min(self.poll_interval, remaining))
+
+    def expire_before(self, ts, batch_size=1000, max_batches=100):
+        """
+        Remove the rankings older than ts, at most batch_size * max_batches,
+        and return how many were removed.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Return the number of stored rankings and the bytes they take.
+        """
+        raise NotImplementedError
+
+
+class SQLiteStore(RankingStore):
+    """
+    Rankings stored in the ranking_data table, optionally deflated with
+    app.lib.compact; writes are serialised by db.write_lock. With
+    track_changes the stored uuids are also appended to ranking_changes.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, compression="none", vacuum="none", poll_interval=0.05, track_changes=False):
+        self.compress = compression == "zlib"
+        self.vacuum = vacuum
+        self.poll_interval = poll_interval
+        self.track_changes = track_changes
+
+    @staticmethod
+    def _load(value):
+        if isinstance(value, str):
+            # stored as text by previous versions
+            return value.encode("utf-8")
+        return compact.decompress(value)
+
+    def put_many(self, rows, offsets=()):
+        stored = [(uuid, ts, compact.compress(rank)) for uuid, ts, rank in rows] if self.compress else rows
+        conn = db.get_connection()
+        with db.write_lock, conn:
+            conn.executemany(UPSERT_RANKING, stored)
+            conn.executemany(UPSERT_OFFSET, offsets)
+            if self.track_changes:
+                conn.executemany(INSERT_CHANGE, [(row[0],) for row in rows])
+                conn.execute(TRIM_CHANGES, [CHANGES_KEPT])
+
+    def load_offsets(self, topic):
+        cur = db.get_connection().execute(
+            'SELECT partition_id, next_offset FROM kafka_offsets WHERE topic=?;', [topic])
+        return dict(cur.fetchall())
+
+    def get(self, uuid):
+        # fetchall resets the statement, releasing its read lock at once
+        rows = db.get_connection().execute('SELECT ts, rank FROM ranking_data WHERE uuid=?;', [uuid]).fetchall()
+        if rows and rows[0][1]:
+            return rows[0][0], self._load(rows[0][1])
+        return None
+
+    def get_many(self, uuids):
+        found = dict()
+        conn = db.get_connection()
+        for i in range(0, len(uuids), QUERY_CHUNK_SIZE):
+            chunk = uuids[i:i + QUERY_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT uuid, ts, rank FROM ranking_data WHERE uuid IN ({placeholders});',
+                                chunk).fetchall()
+            for uuid, ts, rank in rows:
+                if rank:
+                    found[uuid] = (ts, self._load(rank))
+        return found
+
+    def version(self):
+        # changes on every commit of another connection
+        return db.get_connection().execute('PRAGMA data_version;').fetchall()[0][0]
+
+    def changes_since(self, seq):
+        conn = db.get_connection()
+        last = conn.execute('SELECT MAX(seq) FROM ranking_changes;').fetchall()[0][0] or 0
+        if seq is None or last == seq:
+            return last, None if seq is None else ()
+        rows = conn.execute('SELECT seq, uuid FROM ranking_changes WHERE seq > ? ORDER BY seq;', [seq]).fetchall()
+        if rows:
+            last = rows[-1][0]
+        # sequence numbers have no gaps, until the oldest changes are trimmed or the database is reset
+        if not rows or rows[0][0] != seq + 1:
+            return last, None
+        return last, {uuid for _, uuid in rows}
+
+    def expire_before(self, ts, batch_size=1000, max_batches=100):
+        removed = 0
+        conn = db.get_connection()
+        for _ in range(max_batches):
+            # one batch per transaction, so the consumer is never blocked for long
+            with db.write_lock, conn:
+                deleted = conn.execute(DELETE_EXPIRED_BATCH, [ts, batch_size]).rowcount
+            removed += deleted
+            if deleted < batch_size:
+                break
+        if removed and self.vacuum == 'incremental':
+            with db.write_lock:
+                # executescript steps the pragma until the whole freelist is released
+                conn.executescript('PRAGMA incremental_vacuum;')
+        elif removed and self.vacuum == 'full':
+            with db.write_lock:
+                conn.execute('VACUUM;')
+        return removed
+
+    def stats(self):
+        conn = db.get_connection()
+        rankings = conn.execute('SELECT COUNT(*) FROM ranking_data;').fetchall()[0][0]
+        page_count = conn.execute('PRAGMA page_count;').fetchall()[0][0]
+        page_size = conn.execute('PRAGMA page_size;').fetchall()[0][0]
+        return {"backend": self.name, "rankings": rankings, "bytes": page_count * page_size}
+
+
+class _Record:
+    __slots__ = ("ts", "rank")
+
+    def __init__(self, ts, rank):
+        self.ts = ts
+        self.rank = rank
+
+
+class DictStore(RankingStore):
+    """
+    Rankings kept in a dict of the process: no SQL and no copy on read, but
+    nothing is shared with other processes or kept across restarts.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._records = dict()
+        self._offsets = dict()
+        self._version = 0
+        self._changed = threading.Condition()
+
+    def put_many(self, rows, offsets=()):
+        with self._changed:
+            for uuid, ts, rank in rows:
+                record = self._records.get(uuid)
+                # replaced, not updated, so a reader never sees half of a change
+                if record is None or ts >= record.ts:
+                    self._records[uuid] = _Record(ts, rank)
+            for topic, partition, next_offset in offsets:
+                self._offsets[(topic, partition)] = next_offset
+            self._version += 1
+            self._changed.notify_all()
+
+    def load_offsets(self, topic):
+        with self._changed:
+            return {partition: offset for (t, partition), offset in self._offsets.items() if t == topic}
+
+    def get(self, uuid):
+        record = self._records.get(uuid)
+        return None if record is None else (record.ts, record.rank)
+
+    def version(self):
+        return self._version
+
+    def wait_for(self, version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+    def expire_before(self, ts, batch_size=1000, max_batches=100):
+        with self._changed:
+            expired = [uuid for uuid, record in self._records.items() if record.ts < ts]
+            for uuid in expired[:batch_size * max_batches]:
+                del self._records[uuid]
+        return min(len(expired), batch_size * max_batches)
+
+    def stats(self):
+        with self._changed:
+            ranking_bytes = sum(len(record.rank) for record in self._records.values())
+            return {"backend": self.name, "rankings": len(self._records), "bytes": ranking_bytes}
+
+
+class MmapStore(SQLiteStore):
+    """
+    The sqlite backend, mirrored by the ingester into the memory-mapped files
+    at path, which the web workers read instead of querying the database.
+    """
+
+    name = "mmap"
+
+    def __init__(self, path, writer, compression="none", vacuum="none", poll_interval=0.05, track_changes=False):
+        super().__init__(compression=compression, vacuum=vacuum, poll_interval=poll_interval,
+                         track_changes=track_changes)
+        self.path = path
+        self.writer = None
+        self._local = threading.local()
+        if writer:
+            self.writer = mmap_store.MmapStoreWriter(path)
+            self._rebuild()
+
+    def _rebuild(self):
+        # the files are a copy of the database, which may have been reset or have
+        # missed the last batch appended before a crash
+        self.writer.clear()
+        conn = db.connect()
+        try:
+            cur = conn.execute('SELECT uuid, ts, rank FROM ranking_data;')
+            while True:
+                rows = cur.fetchmany(10000)
+                if not rows:
+                    break
+                self.writer.put_many([(uuid, ts, self._load(rank)) for uuid, ts, rank in rows if rank])
+        finally:
+            conn.close()
+
+    def _reader(self):
+        # one reader per thread, since a reader remaps its files when the ingester swaps them
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            reader = self._local.reader = mmap_store.MmapStoreReader(self.path)
+        return reader
+
+    def put_many(self, rows, offsets=()):
+        with db.write_lock:
+            # appended first: workers woken by the new version find the rankings mapped
+            self.writer.put_many(rows)
+            super().put_many(rows, offsets)
+
+    def get(self, uuid):
+        return self._reader().get(uuid)
+
+    def get_many(self, uuids):
+        return RankingStore.get_many(self, uuids)
+
+    def version(self):
+        return self._reader().version()
+
+    def expire_before(self, ts, batch_size=1000, max_batches=100):
+        removed = super().expire_before(ts, batch_size, max_batches)
+        with db.write_lock:
+            # the readers stop serving them at once, compaction reclaims the space later
+            self.writer.expire_before(ts)
+            if removed:
+                self.writer.maybe_compact(ts, removed)
+        return removed
+
+    def stats(self):
+        stats = super().stats()
+        if self.writer is not None:
+            stats["mmap"] = self.writer.stats()
+            stats["bytes"] += self.writer.data_end
+        return stats
+
+
+def create_store(backend, compression="none", vacuum="none", mmap_path=None, writer=True, poll_interval=0.05,
+                 track_changes=False):
+    """
+    Return the storage backend with the given name.
+    Args:
+        backend (str): One of 'sqlite', 'memory' or 'mmap'.
+        compression (str): Format of the rankings in the database, 'none' or 'zlib'.
+        vacuum (str): Vacuum mode of the database after expiring rankings.
+        mmap_path (str): Path of the files of the mmap backend.
+        writer (bool): Whether this process stores the rankings, or only reads them.
+        poll_interval (float): Seconds between two checks of wait_for.
+        track_changes (bool): Whether the database records the stored uuids, for the
+            caches of the processes reading it.
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    if backend == "sqlite":
+        return SQLiteStore(compression=compression, vacuum=vacuum, poll_interval=poll_interval,
+                           track_changes=track_changes)
+    if backend == "memory":
+        return DictStore()
+    if backend == "mmap":
+        return MmapStore(mmap_path, writer, compression=compression, vacuum=vacuum, poll_interval=poll_interval,
+                         track_changes=track_changes)
+    raise ValueError(f"Invalid store backend: {backend}. Valid store backends are {VALID_STORE_BACKENDS}")
@@ -12,21 +12,459 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import asyncio
+import os
+import re
+from collections import OrderedDict
 from flask import current_app as app
+from kafka import TopicPartition  # type: ignore
 import app.kafka_interface as ki
+from app.lib import db
+from app.lib import metrics
+from app.lib import profiling
+from app.lib import store
 import sqlite3
+import threading
 import time
 
+# Whether the consumer thread runs in this process. When a standalone ingester
+# writes the database, pending requests watch it for new commits instead.
+_ingest_local = True
+_db_poll_interval = 0.05
+# Storage backend of the rankings, see app.lib.store
+_store = store.SQLiteStore()
 
-def check_database(logger):
+ingested_messages = metrics.Counter(
+    'okp_ingested_messages_total', 'Ranking messages stored by the consumer thread')
+consumer_lag = metrics.Gauge(
+    'okp_consumer_lag', 'Messages between the last ingested offset and the partition high watermark',
+    ['topic', 'partition'])
+sqlite_write_seconds = metrics.Histogram(
+    'okp_sqlite_write_seconds', 'Time spent writing an ingested batch to the ranking store')
+sqlite_read_seconds = metrics.Histogram(
+    'okp_sqlite_read_seconds', 'Time spent reading rankings from the ranking store')
+rank_request_seconds = metrics.Histogram(
+    'okp_rank_request_seconds',
+    'Ranking lookup time by outcome: immediate hit, waited hit, timeout, negative cache hit or warming up',
+    ['outcome'])
+rank_timeouts = metrics.Counter(
+    'okp_rank_timeouts_total', 'Ranking lookups that waited QUERY_TIMEOUT without finding the ranking')
+rank_batch_request_seconds = metrics.Histogram(
+    'okp_rank_batch_request_seconds', 'Time to serve a /rank/batch request')
+rank_not_found = metrics.Counter(
+    'okp_rank_not_found_total', '/rank requests answered with 404')
+retention_removed = metrics.Counter(
+    'okp_retention_removed_total', 'Rankings removed by the retention job')
+retention_seconds = metrics.Histogram(
+    'okp_retention_seconds', 'Duration of the retention job runs')
+
+
+def _observe_rank_request(start, outcome):
+    rank_request_seconds.labels(outcome).observe(time.perf_counter() - start)
+    if outcome == 'timeout':
+        rank_timeouts.inc()
+
+
+# Pending /rank requests, keyed by deployment uuid. Each entry holds the event
+# the consumer thread sets when the ranking is stored and the number of
+# requests currently waiting on it.
+_waiters = dict()
+# Futures of the requests awaiting a ranking in an asyncio loop (ASGI mode)
+_async_waiters = dict()
+# Events of the batch lookups waiting on several rankings at once
+_batch_waiters = dict()
+_waiters_lock = threading.Lock()
+
+
+def set_ingest_mode(local, poll_interval=0.05):
+    global _ingest_local
+    global _db_poll_interval
+    _ingest_local = local
+    _db_poll_interval = float(poll_interval)
+
+
+def configure_store(backend, logger, compression='none', vacuum='none', mmap_path=None, writer=True,
+                    track_changes=False):
+    """
+    Select the storage backend of the rankings, see app.lib.store.create_store.
+    Called once the database has been checked, which the mmap backend is rebuilt from.
+    """
+    global _store
+    _store = store.create_store(backend, compression=compression, vacuum=vacuum, mmap_path=mmap_path,
+                                writer=writer, poll_interval=_db_poll_interval, track_changes=track_changes)
+    logger.info(f"Storing rankings with the '{backend}' backend")
+
+
+def _register_waiter(uuid):
+    with _waiters_lock:
+        entry = _waiters.get(uuid)
+        if entry is None:
+            entry = _waiters[uuid] = [threading.Event(), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _unregister_waiter(uuid, event):
+    with _waiters_lock:
+        entry = _waiters.get(uuid)
+        if entry is None or entry[0] is not event:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _waiters[uuid]
+
+
+def _register_async_waiter(uuid):
+    future = asyncio.get_running_loop().create_future()
+    with _waiters_lock:
+        _async_waiters.setdefault(uuid, set()).add(future)
+    return future
+
+
+def _unregister_async_waiter(uuid, future):
+    with _waiters_lock:
+        futures = _async_waiters.get(uuid)
+        if futures is not None:
+            futures.discard(future)
+            if not futures:
+                del _async_waiters[uuid]
+
+
+def _register_batch_waiter(uuids):
+    event = threading.Event()
+    with _waiters_lock:
+        for uuid in uuids:
+            _batch_waiters.setdefault(uuid, set()).add(event)
+    return event
+
+
+def _unregister_batch_waiter(uuids, event):
+    with _waiters_lock:
+        for uuid in uuids:
+            events = _batch_waiters.get(uuid)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del _batch_waiters[uuid]
+
+
+def _register_async_batch_waiter(uuids):
+    future = asyncio.get_running_loop().create_future()
+    with _waiters_lock:
+        for uuid in uuids:
+            _async_waiters.setdefault(uuid, set()).add(future)
+    return future
+
+
+def _unregister_async_batch_waiter(uuids, future):
+    for uuid in uuids:
+        _unregister_async_waiter(uuid, future)
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(True)
+
+
+def _notify_waiters(uuid):
+    with _waiters_lock:
+        entry = _waiters.pop(uuid, None)
+        futures = _async_waiters.pop(uuid, ())
+        batch_events = _batch_waiters.pop(uuid, ())
+    if entry is not None:
+        entry[0].set()
+    for event in batch_events:
+        event.set()
+    # called from the consumer thread: hand over to each waiter's event loop
+    for future in futures:
+        future.get_loop().call_soon_threadsafe(_resolve_future, future)
+
+
+class RankingCache:
+    """
+    Bounded in-memory cache of ranking data, keyed by deployment uuid.
+
+    Entries are evicted in LRU order once max_size is reached and expire
+    `lifespan` days after the Kafka timestamp of the message they come from,
+    so the cache never serves data the retention job already removed.
+    """
+
+    def __init__(self, max_size=10000, lifespan=5):
+        self.max_size = int(max_size)
+        self.lifespan = float(lifespan)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expires_at(self, ts):
+        return ts / 1000 + self.lifespan * 86400
+
+    def get(self, uuid):
+        with self._lock:
+            entry = self._data.get(uuid)
+            if entry is not None and entry[0] <= time.time():
+                del self._data[uuid]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(uuid)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, uuid, ts, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entry = self._data.get(uuid)
+            if entry is not None and entry[1] > ts:
+                # keep the most recent ranking for the deployment
+                self._data.move_to_end(uuid)
+                return
+            self._data[uuid] = (self._expires_at(ts), ts, value)
+            self._data.move_to_end(uuid)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, uuid):
+        with self._lock:
+            self._data.pop(uuid, None)
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [uuid for uuid, entry in self._data.items() if entry[0] <= now]
+            for uuid in expired:
+                del self._data[uuid]
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class NegativeCache:
+    """
+    Short-lived set of the uuids whose lookup recently timed out, so retries
+    for expired or never produced deployments fail fast instead of waiting
+    QUERY_TIMEOUT again. Storing a ranking removes its uuid. A timeout may
+    just be a slow AI-Ranker, so it is disabled unless a ttl is given.
+    """
+
+    def __init__(self, max_size=10000, ttl=0):
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, uuid):
+        with self._lock:
+            expires_at = self._data.get(uuid)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._data[uuid]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, uuid):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[uuid] = time.monotonic() + self.ttl
+            self._data.move_to_end(uuid)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, uuid):
+        if self._data:
+            with self._lock:
+                self._data.pop(uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "ttl": self.ttl, "hits": self.hits}
+
+
+ranking_cache = RankingCache()
+negative_cache = NegativeCache()
+
+metrics.Gauge('okp_cache_entries', 'Rankings held in the in-memory cache',
+              function=lambda: ranking_cache.stats()['size'])
+metrics.Counter('okp_cache_hits_total', 'In-memory ranking cache hits', function=lambda: ranking_cache.hits)
+metrics.Counter('okp_cache_misses_total', 'In-memory ranking cache misses', function=lambda: ranking_cache.misses)
+metrics.Counter('okp_negative_cache_hits_total', 'Lookups answered by the negative cache without waiting',
+                function=lambda: negative_cache.hits)
+
+
+def configure_cache(max_size, lifespan, negative_ttl=0):
+    global ranking_cache
+    global negative_cache
+    ranking_cache = RankingCache(max_size=max_size, lifespan=lifespan)
+    negative_cache = NegativeCache(max_size=max_size, ttl=negative_ttl)
+
+
+def get_cache_stats():
+    stats = ranking_cache.stats()
+    stats["negative"] = negative_cache.stats()
+    return stats
+
+
+CREATE_RANKING_TABLE = 'CREATE TABLE IF NOT EXISTS ranking_data (uuid TEXT PRIMARY KEY, ts INTEGER, rank TEXT);'
+CREATE_RANKING_TS_INDEX = 'CREATE INDEX IF NOT EXISTS ranking_data_ts_idx ON ranking_data (ts);'
+# Next offset to read for each partition, written in the same transaction as
+# the rankings so a restart resumes exactly after the last ingested message
+CREATE_OFFSETS_TABLE = (
+    'CREATE TABLE IF NOT EXISTS kafka_offsets '
+    '(topic TEXT, partition_id INTEGER, next_offset INTEGER, PRIMARY KEY (topic, partition_id));'
+)
+# State of the consumer shared with the web workers in external ingest mode
+CREATE_META_TABLE = 'CREATE TABLE IF NOT EXISTS ingest_meta (key TEXT PRIMARY KEY, value TEXT);'
+# Uuids stored in external ingest mode, see app.lib.store.SQLiteStore.changes_since
+CREATE_CHANGES_TABLE = 'CREATE TABLE IF NOT EXISTS ranking_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT);'
+UPSERT_META = "INSERT INTO ingest_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value;"
+
+
+# Move rankings stored with the former un-indexed schema to the keyed table,
+# keeping the most recent row of each deployment.
+def _migrate_ranking_table(conn, logger):
+    columns = conn.execute('PRAGMA table_info(ranking_data);').fetchall()
+    if not columns or any(name == 'uuid' and pk for _, name, _, _, _, pk in columns):
+        return
+    logger.info("Migrating ranking_data table to the uuid primary key schema")
+    conn.executescript(
+        'BEGIN;'
+        'ALTER TABLE ranking_data RENAME TO ranking_data_old;'
+        f'{CREATE_RANKING_TABLE}'
+        'INSERT INTO ranking_data (uuid, ts, rank) '
+        'SELECT uuid, MAX(ts), rank FROM ranking_data_old WHERE uuid IS NOT NULL GROUP BY uuid;'
+        'DROP TABLE ranking_data_old;'
+        'COMMIT;'
+    )
+
+
+_RANKED_PROVIDERS_KEY_RE = re.compile(rb'"ranked_providers"\s*:\s*\[')
+_UUID_MEMBER_RE = re.compile(rb'"uuid"\s*:\s*"([^"\\]*)"')
+
+
+def split_ranking_message(raw):
+    """
+    Extract the deployment uuid and the ranked_providers array from a ranking message.
+
+    The array is returned as the bytes found in the message, ready to be served
+    by /rank. Messages made of just these two members, in either order, with a
+    list of flat provider objects are split by locating the members without
+    decoding the providers; any other layout is fully decoded instead.
+
+    Parameters:
+    - raw (bytes): The Kafka message value.
+    Returns:
+    - tuple: The uuid (str) and the ranked_providers JSON array (bytes).
+    """
+    key = _RANKED_PROVIDERS_KEY_RE.search(raw)
+    uuid_pos = raw.rfind(b'"uuid"')
+    uuid = _UUID_MEMBER_RE.match(raw, uuid_pos) if key and uuid_pos >= 0 else None
+    if uuid is not None:
+        start = key.end() - 1
+        if uuid_pos > start:
+            # {"ranked_providers": [...], "uuid": "..."}
+            end = raw.rfind(b']', start, uuid_pos) + 1
+            layout = [raw[:key.start()], raw[end:uuid_pos], raw[uuid.end():]]
+        else:
+            # {"uuid": "...", "ranked_providers": [...]}
+            end = raw.rfind(b']', start) + 1
+            layout = [raw[:uuid_pos], raw[uuid.end():key.start()], raw[end:]]
+        # the array must hold a single closing bracket, so no other member hides in it
+        if end > start and raw.find(b']', start) == end - 1 and \
+                [part.strip() for part in layout] == [b'{', b',', b'}']:
+            return uuid.group(1).decode('utf-8'), raw[start:end]
+    value = ki.codec.loads(raw)
+    return value['uuid'], ki.codec.dumps(value['ranked_providers'])
+
+
+# JSON values without any provider: an empty array, null or another falsy value
+_EMPTY_RANKING_RE = re.compile(rb'\s*(?:\[\s*\]|\{\s*\}|null|false|0|"")?\s*')
+
+
+def is_empty_ranking(ranking_data):
+    """
+    Whether a ranking, as the JSON bytes served by /rank, ranks no provider;
+    /rank answers 404 for it as for a missing one.
+    """
+    return ranking_data is None or _EMPTY_RANKING_RE.fullmatch(ranking_data) is not None
+
+
+# A shared in-memory database is dropped as soon as its last connection is
+# closed, so check_database keeps one open for the lifetime of the process.
+_db_keepalive = None
+
+
+def check_database(logger, persistent=False, vacuum='none', snapshot_path=None):
+    global _db_keepalive
     conn = None
     try:
         logger.info("Connecting to: '%s'", ki.db_connection)
-        conn = sqlite3.connect(ki.db_connection, timeout=5)
-        conn.execute('CREATE TABLE IF NOT EXISTS ranking_data (uuid TEXT, ts INTEGER, rank TEXT);')
-        conn.execute('DELETE FROM ranking_data;')
+        conn = db.connect()
+        if persistent:
+            # readers are not blocked by the consumer thread while it commits
+            journal_mode = conn.execute('PRAGMA journal_mode=WAL;').fetchone()[0]
+            if journal_mode.lower() != 'wal':
+                logger.warning(f"Database '{ki.db_connection}' does not support WAL; "
+                               f"journal mode is '{journal_mode}'")
+        if vacuum == 'incremental' and conn.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            # the mode of an existing database only changes with a full VACUUM
+            logger.info("Enabling incremental auto-vacuum")
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+            conn.execute('VACUUM;')
+        _migrate_ranking_table(conn, logger)
+        conn.execute(CREATE_RANKING_TABLE)
+        conn.execute(CREATE_RANKING_TS_INDEX)
+        conn.execute(CREATE_OFFSETS_TABLE)
+        conn.execute(CREATE_META_TABLE)
+        conn.execute(CREATE_CHANGES_TABLE)
+        if persistent:
+            rows = conn.execute('SELECT COUNT(*) FROM ranking_data;').fetchone()[0]
+            logger.info(f"Keeping {rows} stored rankings")
+        else:
+            rows = 0
+            conn.execute('DELETE FROM ranking_data;')
+            conn.execute('DELETE FROM kafka_offsets;')
         conn.commit()
+        if not rows and snapshot_path:
+            _restore_snapshot(conn, snapshot_path, logger)
+            # the snapshot may come from a previous schema
+            _migrate_ranking_table(conn, logger)
+            conn.execute(CREATE_RANKING_TABLE)
+            conn.execute(CREATE_RANKING_TS_INDEX)
+            conn.execute(CREATE_OFFSETS_TABLE)
+            conn.execute(CREATE_META_TABLE)
+            conn.execute(CREATE_CHANGES_TABLE)
+            conn.commit()
+        ranking_cache.clear()
+        negative_cache.clear()
+        if _db_keepalive is None:
+            _db_keepalive, conn = conn, None
         logger.info("Operation completed")
     except Exception as e:
         logger.error(e)
@@ -35,61 +473,685 @@ def check_database(logger):
             conn.close()
 
 
+class NotReadyError(Exception):
+    """
+    Raised by a lookup that found nothing while the initial replay of the
+    topic is still in progress.
+    """
+
+
+# Replay of the topic up to the end offsets found at startup, see is_ready()
+_readiness_gate = True
+_replay_lock = threading.Lock()
+_replay_ready = False
+_replay_started = None
+_replay_topic = None
+_replay_targets = dict()
+_replay_positions = dict()
+_external_ready_checked = 0.0
+
+replay_pending = metrics.Gauge(
+    'okp_replay_pending_messages', 'Messages left before the startup replay of the topic is complete')
+
+
+def set_readiness_gate(enabled):
+    global _readiness_gate
+    _readiness_gate = enabled
+
+
+def _set_ready(ready):
+    global _replay_ready
+    _replay_ready = ready
+    conn = db.get_connection()
+    with db.write_lock, conn:
+        conn.execute(UPSERT_META, ['ready', '1' if ready else '0'])
+
+
+def _start_replay_tracking(consumer, topic, offsets, logger):
+    """
+    Record the end offsets of the topic partitions: the service is ready once
+    the consumer position has reached them.
+    """
+    global _replay_started
+    global _replay_topic
+    global _replay_targets
+    global _replay_positions
+    _replay_started = time.monotonic()
+    _replay_topic = topic
+    try:
+        end_offsets = ki.get_end_offsets(consumer, topic)
+        # the messages before the beginning offsets were deleted by the retention of the topic
+        beginning_offsets = ki.get_beginning_offsets(consumer, topic)
+    except Exception as e:
+        logger.warning(f"{e!r}; cannot read the end offsets of {topic}, skipping the readiness gate")
+        end_offsets = dict()
+        beginning_offsets = dict()
+    with _replay_lock:
+        _replay_positions = {p: max(offsets.get(p, 0), beginning_offsets.get(p, 0)) for p in end_offsets}
+        _replay_targets = {p: end for p, end in end_offsets.items() if end > _replay_positions[p]}
+        replay_pending.set(sum(end - _replay_positions[p] for p, end in _replay_targets.items()))
+        if _replay_targets:
+            logger.info(f"Replaying {topic} up to offsets {_replay_targets}")
+        _set_ready(not _replay_targets)
+
+
+def _get_positions(consumer, partitions):
+    """
+    Return the {TopicPartition: position} of the consumer, the offset of the
+    next message it will fetch, past any transaction control record.
+    """
+    positions = dict()
+    for tp in partitions:
+        try:
+            positions[tp] = consumer.position(tp)
+        except Exception:
+            # not assigned (yet) to this consumer
+            continue
+    return positions
+
+
+def _record_replay_progress(positions, logger):
+    if _replay_ready:
+        return
+    with _replay_lock:
+        if _replay_ready:
+            return
+        for tp, position in positions.items():
+            if position is not None:
+                _replay_positions[tp.partition] = max(_replay_positions.get(tp.partition, 0), position)
+        pending = sum(max(end - _replay_positions.get(p, 0), 0) for p, end in _replay_targets.items())
+        replay_pending.set(pending)
+        if pending == 0:
+            _set_ready(True)
+            logger.info(f"Replay completed in {time.monotonic() - _replay_started:.1f}s, the service is ready")
+
+
+def _record_idle_replay_progress(consumer, logger):
+    """
+    Advance the replay to the consumer positions after a poll returned
+    nothing, when the partitions left only have control records or nothing
+    past the messages already stored.
+    """
+    if _replay_ready:
+        return
+    with _replay_lock:
+        partitions = [TopicPartition(_replay_topic, p) for p in _replay_targets]
+    _record_replay_progress(_get_positions(consumer, partitions), logger)
+
+
+def is_ready():
+    """
+    Whether the startup replay of the topic is complete. In external ingest
+    mode the state written by the ingester is read, at most once per second.
+    """
+    global _replay_ready
+    global _external_ready_checked
+    if _replay_ready or _ingest_local:
+        return _replay_ready
+    now = time.monotonic()
+    if now - _external_ready_checked >= 1:
+        _external_ready_checked = now
+        rows = db.get_connection().execute("SELECT value FROM ingest_meta WHERE key='ready';").fetchall()
+        _replay_ready = bool(rows) and rows[0][0] == '1'
+    return _replay_ready
+
+
+def get_readiness():
+    with _replay_lock:
+        pending = {p: max(end - _replay_positions.get(p, 0), 0) for p, end in _replay_targets.items()}
+    return {"ready": is_ready(), "pending_messages": sum(pending.values()),
+            "pending_by_partition": {str(p): n for p, n in pending.items() if n}}
+
+
+def _check_ready(start):
+    if _readiness_gate and not is_ready():
+        _observe_rank_request(start, 'warming_up')
+        raise NotReadyError()
+
+
+def _store_records(records, highwaters, positions, logger):
+    """
+    Decode and store polled messages, {TopicPartition: [messages]}, in one
+    transaction together with the next offset of each partition, then
+    publish them to the cache and the waiters. positions are the consumer
+    positions after the poll, which tell how far the replay has gone.
+    """
+    rows = list()
+    for messages in records.values():
+        for message in messages:
+            try:
+                uuid, rank = split_ranking_message(message.value)
+                rows.append((uuid, message.timestamp, rank))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Skipping malformed message at offset {message.offset}: {e!r}")
+    start = time.perf_counter()
+    _store.put_many(rows, [(tp.topic, tp.partition, messages[-1].offset + 1) for tp, messages in records.items()])
+    sqlite_write_seconds.observe(time.perf_counter() - start)
+    ingested_messages.inc(len(rows))
+    _record_replay_progress({tp: positions.get(tp) for tp in records}, logger)
+    for tp, messages in records.items():
+        highwater = highwaters.get(tp)
+        if highwater is not None:
+            consumer_lag.labels(tp.topic, str(tp.partition)).set(highwater - messages[-1].offset - 1)
+    for uuid, ts, rank in rows:
+        ranking_cache.put(uuid, ts, rank)
+        negative_cache.discard(uuid)
+        _notify_waiters(uuid)
+        logger.debug(f"Loaded {uuid} ranking data.")
+    logger.info(f"Loaded {len(rows)} ranking data.")
+
+
+# Seconds to wait before storing again a batch that failed
+STORE_RETRY_DELAY = 1
+
+
 # Process kafka queue and populate local cache
-def pupulate_ranking_data(topic, logger):
+def pupulate_ranking_data(topic, logger, batch_size=500, flush_interval_ms=1000):
     logger.info("pupulate_ranking_data thread is starting up")
-    consumer = ki.get_topic_consumer_obj(topic, deser_format='json')
+    offsets = _store.load_offsets(topic)
+    if offsets:
+        logger.info(f"Resuming {topic} from stored offsets {offsets}")
+    consumer = ki.get_topic_consumer_obj(topic, deser_format='bytes', max_poll_records=batch_size,
+                                         start_offsets=offsets)
+    _start_replay_tracking(consumer, topic, offsets, logger)
     while True:
+        records = None
         try:
-            for message in consumer:
-                uuid = message.value['uuid']
-                ts = message.timestamp
-                rank = json.dumps(message.value["ranked_providers"])
-                conn = sqlite3.connect(ki.db_connection, timeout=5)
-                conn.execute("INSERT INTO ranking_data VALUES (?, ?, ?);", [uuid, ts, rank])
-                conn.commit()
-                conn.close()
-                logger.info(f"Loaded {uuid} ranking data.")
+            records = consumer.poll(timeout_ms=flush_interval_ms, max_records=batch_size)
+            if not records:
+                _record_idle_replay_progress(consumer, logger)
+                continue
+            highwaters = {tp: consumer.highwater(tp) for tp in records}
+            positions = _get_positions(consumer, records)
+            try:
+                _store_records(records, highwaters, positions, logger)
+            except BaseException:
+                # poll the batch again, instead of storing the next ones over the gap
+                for tp, messages in records.items():
+                    consumer.seek(tp, messages[0].offset)
+                raise
         except BaseException as e:
             logger.error('{!r}; error loading ranking data'.format(e))
+            db.close_connection()
+            if records:
+                time.sleep(STORE_RETRY_DELAY)
+
+
+# Last change of the store applied to the caches in external ingest mode, and when
+_cache_seq = None
+_cache_checked = 0.0
+_cache_lock = threading.Lock()
+
+
+def _revalidate_caches():
+    """
+    In external ingest mode the rankings are stored by another process, which
+    cannot update the caches of the web workers: drop from them the uuids
+    stored since the last check, made at most every DB_POLL_INTERVAL seconds.
+    """
+    global _cache_seq
+    global _cache_checked
+    if time.monotonic() - _cache_checked < _db_poll_interval:
+        return
+    with _cache_lock:
+        now = time.monotonic()
+        if now - _cache_checked < _db_poll_interval:
+            return
+        _cache_checked = now
+        seq, changed = _store.changes_since(_cache_seq)
+        if changed is None:
+            # first check, or the changes since the last one were trimmed
+            ranking_cache.clear()
+            negative_cache.clear()
+        else:
+            for uuid in changed:
+                ranking_cache.discard(uuid)
+                negative_cache.discard(uuid)
+        _cache_seq = seq
+
 
+def _cache_rankings(rankings, seq):
+    """
+    Cache the {uuid: (ts, ranking bytes)} read from the store when the last
+    change applied to the caches was seq.
+    """
+    if _ingest_local:
+        for uuid, (ts, ranking_data) in rankings.items():
+            ranking_cache.put(uuid, ts, ranking_data)
+        return
+    with _cache_lock:
+        # a ranking read before a newer one was stored must not outlive the check dropping it
+        if _cache_seq == seq:
+            for uuid, (ts, ranking_data) in rankings.items():
+                ranking_cache.put(uuid, ts, ranking_data)
 
-# get element from local cache
+
+# get element from local cache, as the JSON bytes served by /rank
+def _query_ranking_data(uuid):
+    seq = _cache_seq
+    start = time.perf_counter()
+    try:
+        found = _store.get(uuid)
+    finally:
+        sqlite_read_seconds.observe(time.perf_counter() - start)
+    if found is None:
+        return None
+    _cache_rankings({uuid: found}, seq)
+    return found[1]
+
+
+def _lookup_ranking_data(uuid):
+    if not _ingest_local:
+        _revalidate_caches()
+    with profiling.phase('cache'):
+        ranking_data = ranking_cache.get(uuid)
+    if ranking_data is None:
+        with profiling.phase('store'):
+            ranking_data = _query_ranking_data(uuid)
+    return ranking_data
+
+
+# Wait for the consumer thread to store the ranking, up to QUERY_TIMEOUT seconds
 def get_ranking_data(uuid):
-    delay = int(app.config.get('QUERY_TIMEOUT', 5))
+    start = time.perf_counter()
+    timeout = float(app.config.get('QUERY_TIMEOUT', 5))
+    deadline = time.monotonic() + timeout
     app.logger.info(f"Requested ranking for deployment id:{uuid}")
-    ranking_data = None
-    conn = None
+    ranking_data = _lookup_ranking_data(uuid)
+    if ranking_data is not None:
+        _observe_rank_request(start, 'hit')
+        return ranking_data
+    _check_ready(start)
+    if uuid in negative_cache:
+        _observe_rank_request(start, 'negative')
+        return None
+    with profiling.phase('wait'):
+        ranking_data = _coalesced_wait(uuid, deadline)
+    if ranking_data is None:
+        negative_cache.add(uuid)
+    _observe_rank_request(start, 'timeout' if ranking_data is None else 'waited')
+    return ranking_data
+
+
+class _Inflight:
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+# Lookups currently waiting for a ranking, so concurrent requests share one
+_inflight = dict()
+_inflight_lock = threading.Lock()
+
+
+def _coalesced_wait(uuid, deadline):
+    """
+    Wait for the ranking with a single database wait loop per uuid: the first
+    request runs it, the concurrent ones wait for its result.
+    """
+    while True:
+        with _inflight_lock:
+            inflight = _inflight.get(uuid)
+            leader = inflight is None
+            if leader:
+                inflight = _inflight[uuid] = _Inflight()
+        if leader:
+            try:
+                inflight.result = (_wait_ranking_data if _ingest_local else _poll_ranking_data)(uuid, deadline)
+            finally:
+                with _inflight_lock:
+                    if _inflight.get(uuid) is inflight:
+                        del _inflight[uuid]
+                inflight.done.set()
+            return inflight.result
+        inflight.done.wait(max(deadline - time.monotonic(), 0))
+        if inflight.result is not None or time.monotonic() >= deadline:
+            return inflight.result
+        # the leader had an earlier deadline: keep waiting with a new lookup
+
+
+def _wait_ranking_data(uuid, deadline):
+    event = _register_waiter(uuid)
     try:
-        while delay > 0:
-            conn = sqlite3.connect(ki.db_connection, timeout=5)
-            cur = conn.cursor()
-            cur.execute('SELECT rank FROM ranking_data WHERE uuid=?;', [uuid])
-            raw = cur.fetchone()
-            if raw:
-                ranking_data = raw[0]
-            if ranking_data:
-                return json.loads(ranking_data)
-            time.sleep(1)
-            delay = delay - 1
+        # the message may have been ingested while registering the waiter
+        ranking_data = _query_ranking_data(uuid)
+        if ranking_data is None and event.wait(max(deadline - time.monotonic(), 0)):
+            ranking_data = _query_ranking_data(uuid)
     finally:
-        if conn:
-            conn.close()
+        _unregister_waiter(uuid, event)
     return ranking_data
 
 
-# Clean local cache
-def clean_ranking_data(lifespan, logger):
-    logger.info("clean_ranking_data thread is starting up")
-    conn = None
+# Query again only when data_version reports a commit from another connection
+def _poll_ranking_data(uuid, deadline):
+    data_version = None
+    while True:
+        version = _store.version()
+        if version != data_version:
+            data_version = version
+            ranking_data = _query_ranking_data(uuid)
+            if ranking_data is not None:
+                return ranking_data
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(_db_poll_interval, remaining))
+
+
+# Same as get_ranking_data, awaiting the ranking without holding a thread
+async def get_ranking_data_async(uuid, timeout):
+    start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    ranking_data = _lookup_ranking_data(uuid)
+    if ranking_data is not None:
+        _observe_rank_request(start, 'hit')
+        return ranking_data
+    _check_ready(start)
+    if uuid in negative_cache:
+        _observe_rank_request(start, 'negative')
+        return None
+    with profiling.phase('wait'):
+        if _ingest_local:
+            # waiting futures already share the consumer notification
+            ranking_data = await _wait_ranking_data_async(uuid, deadline)
+        else:
+            ranking_data = await _coalesced_poll_async(uuid, deadline)
+    if ranking_data is None:
+        negative_cache.add(uuid)
+    _observe_rank_request(start, 'timeout' if ranking_data is None else 'waited')
+    return ranking_data
+
+
+# Database polling tasks of the pending async lookups, one per uuid
+_async_inflight = dict()
+
+
+def _discard_async_inflight(uuid, task):
+    if _async_inflight.get(uuid) is task:
+        del _async_inflight[uuid]
+
+
+async def _coalesced_poll_async(uuid, deadline):
+    while True:
+        task = _async_inflight.get(uuid)
+        if task is None or task.done():
+            task = _async_inflight[uuid] = asyncio.ensure_future(_poll_ranking_data_async(uuid, deadline))
+            task.add_done_callback(lambda t: _discard_async_inflight(uuid, t))
+        try:
+            # shielded: a request timing out must not cancel the poll of the others
+            ranking_data = await asyncio.wait_for(asyncio.shield(task), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            return None
+        if ranking_data is not None or time.monotonic() >= deadline:
+            return ranking_data
+
+
+async def _wait_ranking_data_async(uuid, deadline):
+    future = _register_async_waiter(uuid)
     try:
-        check_time = time.time() - float(lifespan) * 86400
-        conn = sqlite3.connect(ki.db_connection, timeout=5)()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM ranking_data WHERE ranking_data.ts < ?;", [check_time])
-        conn.commit()
-        removed = cur.rowcount
+        # the message may have been ingested while registering the waiter
+        ranking_data = _query_ranking_data(uuid)
+        if ranking_data is None:
+            try:
+                await asyncio.wait_for(future, max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                return None
+            ranking_data = _query_ranking_data(uuid)
+    finally:
+        _unregister_async_waiter(uuid, future)
+    return ranking_data
+
+
+async def _poll_ranking_data_async(uuid, deadline):
+    data_version = None
+    while True:
+        version = _store.version()
+        if version != data_version:
+            data_version = version
+            ranking_data = _query_ranking_data(uuid)
+            if ranking_data is not None:
+                return ranking_data
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(_db_poll_interval, remaining))
+
+
+def _query_ranking_data_many(uuids):
+    seq = _cache_seq
+    start = time.perf_counter()
+    try:
+        rankings = _store.get_many(uuids)
+    finally:
+        sqlite_read_seconds.observe(time.perf_counter() - start)
+    _cache_rankings(rankings, seq)
+    return {uuid: ranking_data for uuid, (ts, ranking_data) in rankings.items()}
+
+
+def _lookup_ranking_data_many(uuids):
+    if not _ingest_local:
+        _revalidate_caches()
+    found = dict()
+    missing = list()
+    for uuid in uuids:
+        ranking_data = ranking_cache.get(uuid)
+        if ranking_data is None:
+            missing.append(uuid)
+        else:
+            found[uuid] = ranking_data
+    if missing:
+        found.update(_query_ranking_data_many(missing))
+    return found
+
+
+# Resolve several rankings at once, waiting for the missing ones up to a shared deadline
+def get_ranking_data_many(uuids, timeout=0):
+    """
+    Return {uuid: ranking JSON bytes} for the given uuids that have a ranking.
+    The cache is checked first, the rest is read with one IN (...) query; with
+    a positive timeout the missing rankings are awaited until it expires.
+    """
+    start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    uuids = list(dict.fromkeys(uuids))
+    found = _lookup_ranking_data_many(uuids)
+    missing = [uuid for uuid in uuids if uuid not in found]
+    if missing and timeout > 0:
+        if _ingest_local:
+            found.update(_wait_ranking_data_many(missing, deadline))
+        else:
+            found.update(_poll_ranking_data_many(missing, deadline))
+    rank_batch_request_seconds.observe(time.perf_counter() - start)
+    return found
+
+
+def _wait_ranking_data_many(uuids, deadline):
+    found = dict()
+    event = _register_batch_waiter(uuids)
+    try:
+        while True:
+            # clear before querying, so a notification arriving meanwhile is not lost
+            event.clear()
+            found.update(_query_ranking_data_many([uuid for uuid in uuids if uuid not in found]))
+            remaining = deadline - time.monotonic()
+            if len(found) == len(uuids) or remaining <= 0 or not event.wait(remaining):
+                return found
+    finally:
+        _unregister_batch_waiter(uuids, event)
+
+
+def _poll_ranking_data_many(uuids, deadline):
+    found = dict()
+    data_version = None
+    while True:
+        version = _store.version()
+        if version != data_version:
+            data_version = version
+            found.update(_query_ranking_data_many([uuid for uuid in uuids if uuid not in found]))
+            if len(found) == len(uuids):
+                return found
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return found
+        time.sleep(min(_db_poll_interval, remaining))
+
+
+# Stream rankings as they are stored, for the /rank/stream watchers
+def watch_ranking_data(uuids, timeout, heartbeat=15):
+    """
+    Yield (uuid, ranking JSON bytes) as soon as each ranking is available and
+    None after `heartbeat` seconds without news, until every ranking has been
+    delivered or `timeout` expires.
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(dict.fromkeys(uuids))
+    registered = list(pending)
+    event = _register_batch_waiter(registered) if _ingest_local else None
+    data_version = None if _ingest_local else _store.version()
+    try:
+        while True:
+            if event is not None:
+                event.clear()
+            found = _lookup_ranking_data_many(pending)
+            for uuid in pending:
+                if uuid in found:
+                    yield uuid, found[uuid]
+            pending = [uuid for uuid in pending if uuid not in found]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return
+            if event is not None:
+                notified = event.wait(min(heartbeat, remaining))
+            else:
+                version = _store.wait_for(data_version, min(heartbeat, remaining))
+                data_version, notified = version, version != data_version
+            if not notified and time.monotonic() < deadline:
+                yield None
+    finally:
+        if event is not None:
+            _unregister_batch_waiter(registered, event)
+
+
+# Same as watch_ranking_data, awaiting the rankings without holding a thread
+async def watch_ranking_data_async(uuids, timeout, heartbeat=15):
+    deadline = time.monotonic() + timeout
+    pending = list(dict.fromkeys(uuids))
+    data_version = None
+    while True:
+        future = _register_async_batch_waiter(pending) if _ingest_local else None
+        registered = list(pending)
+        try:
+            if not _ingest_local:
+                data_version = _store.version()
+            found = _lookup_ranking_data_many(pending)
+            for uuid in pending:
+                if uuid in found:
+                    yield uuid, found[uuid]
+            pending = [uuid for uuid in pending if uuid not in found]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return
+            wait_until = time.monotonic() + min(heartbeat, remaining)
+            notified = False
+            if future is not None:
+                try:
+                    await asyncio.wait_for(future, wait_until - time.monotonic())
+                    notified = True
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                while not notified and time.monotonic() < wait_until:
+                    await asyncio.sleep(min(_db_poll_interval, max(wait_until - time.monotonic(), 0)))
+                    notified = _store.version() != data_version
+            if not notified and time.monotonic() < deadline:
+                yield None
+        finally:
+            if future is not None:
+                _unregister_async_batch_waiter(registered, future)
+
+
+def expire_cache(logger):
+    expired = ranking_cache.expire()
+    logger.debug(f"Invalidated {expired} ranking cache entries; cache stats: {ranking_cache.stats()}")
+
+
+def get_store_stats():
+    return _store.stats()
+
+
+def count_ranking_data():
+    return _store.stats()["rankings"]
+
+
+metrics.Gauge('okp_store_rows', 'Rankings stored in the database', function=count_ranking_data)
+
+
+# Clean local cache: remove the rankings older than lifespan days, in batches of
+# batch_size rows and at most max_batches per run so the consumer thread is never
+# blocked for long; what is left is removed by the next run
+def clean_ranking_data(lifespan, logger, batch_size=1000, max_batches=100):
+    logger.debug("clean_ranking_data thread is starting up")
+    start = time.perf_counter()
+    expire_cache(logger)
+    removed = 0
+    try:
+        # Kafka timestamps are in milliseconds
+        check_time = int((time.time() - float(lifespan) * 86400) * 1000)
+        removed = _store.expire_before(check_time, batch_size, max_batches)
+    except Exception as e:
+        logger.error('{!r}; error cleaning ranking data'.format(e))
+    finally:
+        retention_removed.inc(removed)
+        retention_seconds.observe(time.perf_counter() - start)
+    if removed:
         logger.info(f"Removed {removed} messages from ranking data.")
+    return removed
+
+
+snapshot_seconds = metrics.Histogram(
+    'okp_snapshot_seconds', 'Time spent writing a snapshot of the ranking store')
+
+
+# Write a compact copy of the store, rankings and partition offsets, for the next cold start
+def write_snapshot(path, logger):
+    start = time.perf_counter()
+    tmp_path = f"{path}.tmp"
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # no batch is half written while copying, so the offsets match the rankings
+        with db.write_lock:
+            db.get_connection().execute('VACUUM INTO ?;', [tmp_path])
+        os.replace(tmp_path, path)
+        logger.info(f"Snapshot of the ranking data written to '{path}' "
+                    f"({os.path.getsize(path)} bytes) in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logger.error('{!r}; error writing the ranking data snapshot'.format(e))
     finally:
-        if conn:
-            conn.close()
+        snapshot_seconds.observe(time.perf_counter() - start)
+
+
+def _restore_snapshot(conn, path, logger):
+    """
+    Replace the content of the empty store with the snapshot at path, if any.
+    """
+    if not path or not os.path.exists(path):
+        return
+    start = time.perf_counter()
+    try:
+        snapshot = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            snapshot.backup(conn)
+        finally:
+            snapshot.close()
+        rows = conn.execute('SELECT COUNT(*) FROM ranking_data;').fetchone()[0]
+        offsets = conn.execute('SELECT partition_id, next_offset FROM kafka_offsets;').fetchall()
+        logger.info(f"Restored {rows} rankings from snapshot '{path}' in {time.perf_counter() - start:.2f}s, "
+                    f"resuming from offsets {dict(offsets)}")
+    except Exception as e:
+        logger.error('{!r}; cannot restore snapshot {}, replaying the topic'.format(e, path))
+        conn.rollback()
+        conn.execute('DELETE FROM ranking_data;')
+        conn.execute('DELETE FROM kafka_offsets;')
@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hmac
 from flask import (
     abort,
     Blueprint,
+    jsonify,
     request,
+    Response,
 )
+from werkzeug.exceptions import NotFound
+import app.kafka_interface as ki
 import app.ranking_processor as rp
+from app.lib import metrics
+from app.lib import profiling
 from flask import current_app as app
 
 cpr_bp = Blueprint(
@@ -32,10 +39,185 @@ def root():
 
 @cpr_bp.route("/rank", methods=['POST'])
 def get_deployment_rank():
+    token = profiling.start_request()
+    try:
+        response = profiling.run_profiled(_rank_response)
+    finally:
+        timings = None if token is None else profiling.finish_request(token)
+    if timings is not None:
+        response.headers["Server-Timing"] = profiling.server_timing(timings)
+        log_rank_timings(request.get_data(as_text=True), response.status_code, timings)
+    return response
+
+
+def _rank_response():
     uuid = request.data
     if isinstance(uuid, bytes):
         uuid = uuid.decode("utf-8")
-    ranking_data = rp.get_ranking_data(uuid)
-    if ranking_data:
-        return ranking_data
-    abort(404)
+    try:
+        ranking_data = rp.get_ranking_data(uuid)
+    except rp.NotReadyError:
+        return warming_up_response()
+    with profiling.phase("response"):
+        if not rp.is_empty_ranking(ranking_data):
+            return Response(ranking_data, mimetype="application/json")
+        rp.rank_not_found.inc()
+        return NotFound().get_response()
+
+
+def log_rank_timings(uuid, status, timings):
+    # only a sample, so the log keeps up with the request rate
+    if profiling.should_log():
+        app.logger.info(f"Timing of /rank for deployment id:{uuid} ({status}): {profiling.format_timings(timings)}")
+
+
+WARMING_UP_BODY = b'{"status":"warming up"}'
+# Seconds a client is asked to wait before retrying during the startup replay
+WARMING_UP_RETRY_AFTER = "1"
+
+
+def warming_up_response():
+    return Response(WARMING_UP_BODY, status=503, mimetype="application/json",
+                    headers={"Retry-After": WARMING_UP_RETRY_AFTER})
+
+
+@cpr_bp.route("/ready")
+def get_readiness():
+    readiness = rp.get_readiness()
+    return jsonify(readiness), 200 if readiness["ready"] else 503
+
+
+@cpr_bp.route("/rank/batch", methods=['POST'])
+def get_deployments_rank():
+    uuids = request.get_json(silent=True)
+    if not isinstance(uuids, list) or not all(isinstance(uuid, str) for uuid in uuids):
+        abort(400, description="The payload must be a JSON array of deployment ids")
+    max_ids = int(app.config.get("RANK_BATCH_MAX_IDS", 1000))
+    if len(uuids) > max_ids:
+        abort(400, description=f"At most {max_ids} deployment ids can be requested at once")
+    wait = request.args.get("wait", "false").lower() in ("1", "true", "yes")
+    timeout = float(app.config.get("QUERY_TIMEOUT", 5)) if wait else 0
+    app.logger.info(f"Requested ranking for {len(uuids)} deployment ids")
+    found = rp.get_ranking_data_many(uuids, timeout)
+    # the stored rankings are already JSON: splice them in instead of decoding them
+    rankings = b",".join(ki.codec.dumps(uuid) + b":" + ranking_data for uuid, ranking_data in found.items())
+    missing = [uuid for uuid in dict.fromkeys(uuids) if uuid not in found]
+    body = b'{"missing":' + ki.codec.dumps(missing) + b',"rankings":{' + rankings + b'}}'
+    return Response(body, mimetype="application/json")
+
+
+SSE_HEARTBEAT = b": keepalive\n\n"
+
+
+def sse_ranking_event(uuid, ranking_data):
+    """
+    Format a ranking as a Server-Sent Event carrying the same JSON object
+    published by the AI-Ranker.
+    """
+    # line breaks in JSON can only be whitespace, and would end the SSE data field
+    ranking_data = ranking_data.replace(b"\r", b" ").replace(b"\n", b" ")
+    return b'event: ranking\ndata: {"uuid":' + ki.codec.dumps(uuid) + b',"ranked_providers":' + ranking_data + b'}\n\n'
+
+
+# Seconds a stream served by gunicorn ends before the WORKER_TIMEOUT
+STREAM_TIMEOUT_MARGIN = 5
+
+
+def sse_timeout_event(missing):
+    return b'event: timeout\ndata: {"missing":' + ki.codec.dumps(missing) + b'}\n\n'
+
+
+def validate_stream_ids(uuids, max_ids):
+    """
+    Validate the deployment ids of a /rank/stream request.
+    Returns:
+        str: The error message, or None if the ids are valid.
+    """
+    if not uuids:
+        return "At least one deployment id must be given with the 'id' parameter"
+    if len(uuids) > max_ids:
+        return f"At most {max_ids} deployment ids can be requested at once"
+    return None
+
+
+@cpr_bp.route("/rank/stream")
+def stream_deployments_rank():
+    uuids = request.args.getlist("id")
+    error = validate_stream_ids(uuids, int(app.config.get("RANK_BATCH_MAX_IDS", 1000)))
+    if error:
+        abort(400, description=error)
+    timeout = float(app.config.get("RANK_STREAM_TIMEOUT", 300))
+    heartbeat = float(app.config.get("RANK_STREAM_HEARTBEAT", 15))
+    worker_timeout = app.config.get("WORKER_TIMEOUT")
+    if worker_timeout:
+        # end the stream before gunicorn deems the worker stuck and restarts it
+        timeout = min(timeout, max(float(worker_timeout) - STREAM_TIMEOUT_MARGIN, 1))
+    app.logger.info(f"Streaming ranking for deployment ids:{uuids}")
+
+    def generate():
+        delivered = set()
+        for item in rp.watch_ranking_data(uuids, timeout, heartbeat):
+            if item is None:
+                yield SSE_HEARTBEAT
+                continue
+            delivered.add(item[0])
+            yield sse_ranking_event(*item)
+        missing = [uuid for uuid in dict.fromkeys(uuids) if uuid not in delivered]
+        if missing:
+            yield sse_timeout_event(missing)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@cpr_bp.route("/cache/stats")
+def get_cache_stats():
+    return jsonify(rp.get_cache_stats())
+
+
+@cpr_bp.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _check_admin_token():
+    # the admin routes only exist with profiling enabled and a token to guard them
+    token = app.config.get("PROFILING_TOKEN")
+    if not profiling.enabled or not token:
+        abort(404)
+    given = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(given.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+        abort(401)
+
+
+@cpr_bp.route("/admin/profile", methods=['POST'])
+def profile_worker():
+    _check_admin_token()
+    mode = request.args.get("mode", "cprofile")
+    if mode not in ("cprofile", "stack"):
+        abort(400, description="The mode must be 'cprofile' or 'stack'")
+    max_seconds = float(app.config.get("PROFILING_MAX_SECONDS", 30))
+    try:
+        seconds = float(request.args.get("seconds", 5))
+    except ValueError:
+        seconds = -1
+    if not 0 < seconds <= max_seconds:
+        abort(400, description=f"The duration must be between 0 and {max_seconds} seconds")
+    try:
+        profiling.start_profile(mode, seconds)
+    except ValueError as e:
+        abort(409, description=str(e))
+    app.logger.info(f"Profiling this worker for {seconds}s in '{mode}' mode")
+    return jsonify({"status": "running", "mode": mode, "seconds": seconds}), 202
+
+
+@cpr_bp.route("/admin/profile")
+def get_worker_profile():
+    _check_admin_token()
+    last = profiling.get_profile()
+    if last is None:
+        abort(404, description="No profile was started on this worker")
+    mode, seconds, report = last
+    if report is None:
+        return jsonify({"status": "running", "mode": mode, "seconds": seconds}), 202
+    return Response(report, mimetype="text/plain")
@@ -5,6 +5,7 @@ CA_BUNDLE_PATH=$(python3 -m certifi)
 CERT_PATH=${CERT_PATH:-"/trusted_certs"}
 TIMEOUT=${TIMEOUT:-"60"}
 WORKERS=${WORKERS:-"1"}
+THREADS=${THREADS:-"8"}
 CERT=${CERT:-"/certs/cert.pem"}
 KEY=${KEY:-"/certs/key.pem"}
 PORT=${PORT:-"5001"}
@@ -29,14 +30,41 @@ else
   cd -
 fi
 
+# With INGEST_MODE "external" a single ingester process consumes the ranking
+# topic and writes the shared database, the gunicorn workers only read it.
+if [ "${FLASK_INGEST_MODE}" == "external" ]; then
+  ( while true; do
+      python3 orchestrator_kafka_ingester.py
+      echo "[WARNING] Ingester exited, restarting in 5 seconds"
+      sleep 5
+    done ) &
+fi
+
+# With SERVER_MODE "asgi" /rank is served by uvicorn on the event loop, so
+# pending requests do not hold a worker thread while waiting for the ranking.
+if [ "${SERVER_MODE}" == "asgi" ]; then
+  if [ "${ENABLE_HTTPS,}" == "true" ]; then
+    if test -e "$CERT" && test -f "$KEY" ; then
+      exec uvicorn --host 0.0.0.0 --port $PORT --workers "$WORKERS" --ssl-certfile "$CERT" --ssl-keyfile "$KEY" orchestrator_kafka_proxy_asgi:application
+    else
+      echo "[ERROR] File $CERT or $KEY NOT FOUND!"
+      exit 1
+    fi
+  else
+    exec uvicorn --host 0.0.0.0 --port $PORT --workers "$WORKERS" orchestrator_kafka_proxy_asgi:application
+  fi
+fi
 
+# Threaded workers, so a /rank/stream watcher does not hold the whole worker;
+# the streams end before the worker timeout, passed to the application.
+export FLASK_WORKER_TIMEOUT="$TIMEOUT"
 if [ "${ENABLE_HTTPS,}" == "true" ]; then
   if test -e "$CERT" && test -f "$KEY" ; then
-    exec gunicorn --bind 0.0.0.0:$PORT -w "$WORKERS" --certfile "$CERT" --keyfile "$KEY" --timeout "$TIMEOUT"  orchestrator-kafka-proxy:app
+    exec gunicorn --bind 0.0.0.0:$PORT -w "$WORKERS" --worker-class gthread --threads "$THREADS" --certfile "$CERT" --keyfile "$KEY" --timeout "$TIMEOUT"  orchestrator-kafka-proxy:app
   else
     echo "[ERROR] File $CERT or $KEY NOT FOUND!"
     exit 1
   fi
 else
-  exec gunicorn --bind 0.0.0.0:$PORT -w "$WORKERS" --timeout "$TIMEOUT"  orchestrator-kafka-proxy:app
+  exec gunicorn --bind 0.0.0.0:$PORT -w "$WORKERS" --worker-class gthread --threads "$THREADS" --timeout "$TIMEOUT"  orchestrator-kafka-proxy:app
 fi
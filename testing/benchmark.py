@@ -0,0 +1,218 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline benchmark of the service on an in-process Kafka stand-in.
+
+Measures the startup replay time, the ingest throughput of a burst, the
+memory used per 10k stored rankings and the POST /rank latency of hits, late
+arrivals and misses. Payloads are synthesised from the get_topic_data shapes
+with a fixed seed, and the results are printed as JSON.
+
+Run from the repository root: python -m testing.benchmark [-o results.json]
+Service settings are read as usual from the FLASK_* environment variables.
+With FLASK_INGEST_MODE "external" (implied by FLASK_STORE_BACKEND "mmap") the
+consumer runs in an in-process ingester, writing a database and the mmap files
+in a temporary directory unless their paths are set, and the /rank requests
+take the path of a web worker reading what it stores.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import uuid
+from testing import fake_kafka
+from testing.populate_kafka import get_topic_data
+
+TOPIC = "ranked-providers"
+
+
+def synthesize(rng, count):
+    """
+    Return count ranking messages with random ids and jittered numeric values.
+    """
+    shapes = get_topic_data()
+    messages = list()
+    for _ in range(count):
+        shape = rng.choice(shapes)
+        providers = [
+            {k: v * rng.uniform(0.5, 1.5) if isinstance(v, float) else v for k, v in provider.items()}
+            for provider in shape["ranked_providers"]
+        ]
+        messages.append({"uuid": str(uuid.UUID(int=rng.getrandbits(128))), "ranked_providers": providers})
+    return messages
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return dict()
+
+    def at(q):
+        return round(samples[min(int(q * len(samples)), len(samples) - 1)] * 1000, 3)
+
+    return {"count": len(samples), "p50_ms": at(0.5), "p99_ms": at(0.99), "max_ms": round(samples[-1] * 1000, 3)}
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def wait_ingested(rp, target, timeout=600):
+    deadline = time.monotonic() + timeout
+    while rp.ingested_messages._default.value < target:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"only {rp.ingested_messages._default.value} of {target} messages ingested")
+        time.sleep(0.001)
+    return time.perf_counter()
+
+
+def post_rank(client, deployment_id):
+    start = time.perf_counter()
+    response = client.post("/cpr/rank", data=deployment_id)
+    return response.status_code, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", type=int, default=20000, help="messages in the topic at startup")
+    parser.add_argument("--burst", type=int, default=10000, help="messages published at once after startup")
+    parser.add_argument("--partitions", type=int, default=4, help="partitions of the ranking topic")
+    parser.add_argument("--hits", type=int, default=2000, help="/rank requests for stored rankings")
+    parser.add_argument("--late", type=int, default=200, help="/rank requests for rankings published later")
+    parser.add_argument("--late-delay", type=float, default=0.05, help="seconds before a late ranking is published")
+    parser.add_argument("--misses", type=int, default=20, help="/rank requests for unknown deployments")
+    parser.add_argument("--query-timeout", type=float, default=0.2, help="QUERY_TIMEOUT of the service")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthesised payloads")
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    os.environ.setdefault("FLASK_LOG_LEVEL", "WARNING")
+    os.environ["FLASK_QUERY_TIMEOUT"] = str(args.query_timeout)
+    os.environ["FLASK_KAFKA_BOOTSTRAP_SERVERS"] = "fake-kafka:9092"
+    os.environ["FLASK_KAFKA_RANKING_TOPIC"] = TOPIC
+    if os.environ.get("FLASK_STORE_BACKEND") == "mmap":
+        os.environ.setdefault("FLASK_INGEST_MODE", "external")
+    external = os.environ.get("FLASK_INGEST_MODE") == "external"
+    workdir = tempfile.TemporaryDirectory(prefix="okp-benchmark-")
+    if external:
+        # the ingester and the web workers share a database file and the mmap files
+        os.environ.setdefault("FLASK_DB_CONNECTION", f"file:{os.path.join(workdir.name, 'rankings.db')}")
+        os.environ.setdefault("FLASK_MMAP_STORE_PATH", os.path.join(workdir.name, "rankings"))
+
+    import app.kafka_interface as ki
+    import app.ranking_processor as rp
+    from app import create_app
+
+    rng = random.Random(args.seed)
+    broker = fake_kafka.FakeBroker(partitions=args.partitions)
+    fake_kafka.install(broker)
+    ki.set_global_vars(b_db_connection=None, b_servers="fake-kafka:9092", k_ssl_enable=False, k_ssl_ca_path=None,
+                       k_ssl_cert_path=None, k_ssl_key_path=None, k_ssl_password=None)
+    replayed = synthesize(rng, args.replay)
+    ki.send_msgs(replayed, TOPIC)
+    results = {"args": vars(args), "python": platform.python_version(),
+               "ingest_mode": "external" if external else "embedded"}
+
+    # startup: replay of the whole topic
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    app = create_app(ingester=external)
+    end = wait_ingested(rp, args.replay)
+    if external:
+        # the consumer thread keeps ingesting, the requests read the store as a web worker does
+        rp.set_ingest_mode(local=False, poll_interval=float(os.environ.get("FLASK_DB_POLL_INTERVAL", 0.05)))
+    results["codec"] = ki.codec.name
+    results["replay"] = {
+        "messages": args.replay,
+        "seconds": round(end - start, 3),
+        "messages_per_second": round(args.replay / (end - start)),
+    }
+    store_stats = rp.get_store_stats()
+    results["store"] = store_stats["backend"]
+    results["memory_per_10k"] = {
+        "store_bytes": round(store_stats["bytes"] * 10000 / args.replay),
+        "process_rss_bytes": round((rss_bytes() - rss_before) * 10000 / args.replay),
+    }
+
+    # ingest of a burst published while running
+    burst = synthesize(rng, args.burst)
+    start = time.perf_counter()
+    ki.send_msgs(burst, TOPIC)
+    end = wait_ingested(rp, args.replay + args.burst)
+    results["burst_ingest"] = {
+        "messages": args.burst,
+        "seconds": round(end - start, 3),
+        "messages_per_second": round(args.burst / (end - start)),
+    }
+
+    client = app.test_client()
+    stored = [m["uuid"] for m in replayed + burst]
+
+    # hits: half served by the cache, half read from the database
+    rp.ranking_cache.clear()
+    latencies = list()
+    for deployment_id in rng.sample(stored, min(args.hits, len(stored))) * 2:
+        status, elapsed = post_rank(client, deployment_id)
+        assert status == 200, status
+        latencies.append(elapsed)
+    results["rank_hit"] = percentiles(latencies)
+
+    # late arrivals: measured from the publication of the ranking to the response
+    late = synthesize(rng, args.late)
+    latencies = list()
+    for message in late:
+        outcome = dict()
+
+        def request(deployment_id=message["uuid"]):
+            outcome["status"], _ = post_rank(client, deployment_id)
+            outcome["end"] = time.perf_counter()
+
+        waiter = threading.Thread(target=request)
+        waiter.start()
+        time.sleep(args.late_delay)
+        published = time.perf_counter()
+        ki.send_msg(message, TOPIC)
+        waiter.join()
+        assert outcome["status"] == 200, outcome["status"]
+        latencies.append(outcome["end"] - published)
+    results["rank_late"] = percentiles(latencies)
+
+    # misses: unknown deployments wait QUERY_TIMEOUT, repeated ones hit the negative cache
+    unknown = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.misses)]
+    for name, deployment_ids in (("rank_miss", unknown), ("rank_repeated_miss", unknown)):
+        latencies = list()
+        for deployment_id in deployment_ids:
+            status, elapsed = post_rank(client, deployment_id)
+            assert status == 404, status
+            latencies.append(elapsed)
+        results[name] = percentiles(latencies)
+
+    workdir.cleanup()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
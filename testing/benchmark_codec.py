@@ -0,0 +1,58 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark of the JSON codecs on the ranking payloads of get_topic_data.
+
+Run from the repository root: python -m testing.benchmark_codec
+"""
+
+import argparse
+import timeit
+from app.lib.codec import CODECS, get_codec
+from testing.populate_kafka import get_topic_data
+
+
+def benchmark(codec, messages, encoded, number):
+    decode = timeit.timeit(lambda: [codec.loads(m) for m in encoded], number=number)
+    encode = timeit.timeit(lambda: [codec.dumps(m, sort_keys=True) for m in messages], number=number)
+    count = len(messages) * number
+    return decode / count * 1e6, encode / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=2000, help="passes over the payloads")
+    args = parser.parse_args()
+
+    messages = get_topic_data()
+    encoded = [get_codec("json").dumps(m, sort_keys=True) for m in messages]
+    size = sum(len(m) for m in encoded) / len(encoded)
+    print(f"{len(messages)} payloads, {size:.0f} bytes on average, {args.number} passes")
+    print(f"{'codec':<10}{'decode us/msg':>15}{'encode us/msg':>15}{'speedup':>10}")
+
+    results = dict()
+    for name, (_, available) in CODECS.items():
+        if available():
+            results[name] = benchmark(get_codec(name), messages, encoded, args.number)
+    baseline = sum(results["json"])
+    for name in CODECS:
+        if name not in results:
+            print(f"{name:<10}{'not installed':>15}")
+            continue
+        decode, encode = results[name]
+        print(f"{name:<10}{decode:>15.2f}{encode:>15.2f}{baseline / (decode + encode):>9.1f}x")
+
+if __name__ == "__main__":
+    main()
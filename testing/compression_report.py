@@ -0,0 +1,75 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Size of the ranking database with DB_COMPRESSION "none" and "zlib", filled
+with the ranking payloads of get_topic_data under random deployment ids.
+
+Run from the repository root: python -m testing.compression_report
+"""
+
+import argparse
+import sqlite3
+import timeit
+import uuid
+from app.lib import compact
+from app.lib.codec import get_codec
+from app.lib.store import UPSERT_RANKING
+from app.ranking_processor import CREATE_RANKING_TABLE, CREATE_RANKING_TS_INDEX
+from testing.populate_kafka import get_topic_data
+
+
+def database_size(payloads, count, compress):
+    conn = sqlite3.connect(":memory:")
+    conn.execute(CREATE_RANKING_TABLE)
+    conn.execute(CREATE_RANKING_TS_INDEX)
+    rows = list()
+    for i in range(count):
+        rank = payloads[i % len(payloads)]
+        rows.append((str(uuid.uuid4()), i, compact.compress(rank) if compress else rank))
+    with conn:
+        conn.executemany(UPSERT_RANKING, rows)
+    page_count = conn.execute("PRAGMA page_count;").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+    conn.close()
+    return page_count * page_size, sum(len(row[2]) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--count", type=int, default=10000, help="deployments stored")
+    args = parser.parse_args()
+
+    codec = get_codec("json")
+    payloads = [codec.dumps(m["ranked_providers"], sort_keys=True) for m in get_topic_data()]
+    for payload in payloads:
+        assert compact.decompress(compact.compress(payload)) == payload
+
+    text_db, text_payloads = database_size(payloads, args.count, compress=False)
+    zlib_db, zlib_payloads = database_size(payloads, args.count, compress=True)
+    print(f"{args.count} deployments, {text_payloads / args.count:.0f} payload bytes on average")
+    print(f"{'format':<8}{'payloads MiB':>15}{'database MiB':>15}{'ratio':>8}")
+    for name, db_size, payload_size in (("none", text_db, text_payloads), ("zlib", zlib_db, zlib_payloads)):
+        print(f"{name:<8}{payload_size / 2**20:>15.2f}{db_size / 2**20:>15.2f}{text_db / db_size:>7.1f}x")
+
+    number = 200
+    compressed = [compact.compress(p) for p in payloads]
+    encode = timeit.timeit(lambda: [compact.compress(p) for p in payloads], number=number)
+    decode = timeit.timeit(lambda: [compact.decompress(c) for c in compressed], number=number)
+    count = len(payloads) * number
+    print(f"compress {encode / count * 1e6:.1f} us/payload, decompress {decode / count * 1e6:.1f} us/payload")
+
+
+if __name__ == "__main__":
+    main()
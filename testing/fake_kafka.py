@@ -0,0 +1,198 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for the Kafka broker, used to run the service offline.
+
+install(broker) replaces the KafkaConsumer and KafkaProducer classes used by
+app.kafka_interface, so every client built by create_consumer and
+create_producer reads from and writes to the given FakeBroker.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from kafka import TopicPartition  # type: ignore
+import app.kafka_interface as ki
+
+FakeRecord = namedtuple("FakeRecord", "topic partition offset timestamp key value")
+FakeRecordMetadata = namedtuple("FakeRecordMetadata", "topic partition offset timestamp")
+
+
+class FakeBroker:
+    """
+    Topics made of in-memory partition logs. Records without a key are spread
+    over the partitions round robin, keyed ones by key hash.
+    """
+
+    def __init__(self, partitions=1):
+        self.partitions = int(partitions)
+        self._logs = dict()
+        self._next_partition = 0
+        self._condition = threading.Condition()
+
+    def _topic(self, topic):
+        return self._logs.setdefault(topic, [list() for _ in range(self.partitions)])
+
+    def append(self, topic, value, key=None):
+        with self._condition:
+            logs = self._topic(topic)
+            if key is None:
+                partition = self._next_partition % self.partitions
+                self._next_partition += 1
+            else:
+                partition = hash(key) % self.partitions
+            log = logs[partition]
+            record = FakeRecord(topic, partition, len(log), int(time.time() * 1000), key, value)
+            log.append(record)
+            self._condition.notify_all()
+        return FakeRecordMetadata(topic, partition, record.offset, record.timestamp)
+
+    def partitions_for_topic(self, topic):
+        with self._condition:
+            return set(range(len(self._topic(topic))))
+
+    def end_offset(self, topic, partition):
+        with self._condition:
+            return len(self._topic(topic)[partition])
+
+    def read(self, positions, max_records, timeout):
+        """
+        Return up to max_records records after the given {TopicPartition: offset}
+        positions, waiting up to timeout seconds for the first one.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                records = dict()
+                for tp, offset in positions.items():
+                    if max_records <= 0:
+                        break
+                    log = self._topic(tp.topic)[tp.partition]
+                    batch = log[offset:offset + max_records]
+                    if batch:
+                        records[tp] = batch
+                        max_records -= len(batch)
+                remaining = deadline - time.monotonic()
+                if records or remaining <= 0:
+                    return records
+                self._condition.wait(remaining)
+
+
+class FakeFuture:
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def get(self, timeout=None):
+        return self.metadata
+
+    def is_done(self):
+        return True
+
+
+class FakeConsumer:
+    """
+    The subset of KafkaConsumer used by the service.
+    """
+
+    def __init__(self, broker, *topics, value_deserializer=None, max_poll_records=500, consumer_timeout_ms=None,
+                 **options):
+        self.broker = broker
+        self.value_deserializer = value_deserializer
+        self.max_poll_records = max_poll_records
+        self.consumer_timeout_ms = consumer_timeout_ms
+        self._positions = dict()
+        if topics:
+            self.subscribe(list(topics))
+
+    def subscribe(self, topics):
+        for topic in topics:
+            for partition in sorted(self.broker.partitions_for_topic(topic)):
+                self._positions[TopicPartition(topic, partition)] = 0
+
+    def partitions_for_topic(self, topic):
+        return self.broker.partitions_for_topic(topic)
+
+    def assign(self, partitions):
+        self._positions = {tp: 0 for tp in partitions}
+
+    def seek(self, tp, offset):
+        self._positions[tp] = offset
+
+    def seek_to_beginning(self, *partitions):
+        for tp in partitions or list(self._positions):
+            self._positions[tp] = 0
+
+    def beginning_offsets(self, partitions):
+        return {tp: 0 for tp in partitions}
+
+    def end_offsets(self, partitions):
+        return {tp: self.broker.end_offset(tp.topic, tp.partition) for tp in partitions}
+
+    def position(self, tp):
+        return self._positions[tp]
+
+    def highwater(self, tp):
+        return self.broker.end_offset(tp.topic, tp.partition)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        records = self.broker.read(self._positions, max_records or self.max_poll_records, timeout_ms / 1000)
+        for tp, batch in records.items():
+            self._positions[tp] = batch[-1].offset + 1
+            if self.value_deserializer is not None:
+                records[tp] = [r._replace(value=self.value_deserializer(r.value)) for r in batch]
+        return records
+
+    def __iter__(self):
+        timeout_ms = self.consumer_timeout_ms or 1000
+        while True:
+            records = self.poll(timeout_ms=timeout_ms)
+            if not records:
+                return
+            for batch in records.values():
+                yield from batch
+
+    def close(self):
+        pass
+
+
+class FakeProducer:
+    """
+    The subset of KafkaProducer used by the service: records are appended to
+    the broker at once.
+    """
+
+    def __init__(self, broker, value_serializer=None, **options):
+        self.broker = broker
+        self.value_serializer = value_serializer
+
+    def send(self, topic, value=None, key=None):
+        if self.value_serializer is not None:
+            value = self.value_serializer(value)
+        return FakeFuture(self.broker.append(topic, value, key))
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+def install(broker):
+    """
+    Make app.kafka_interface build its clients on the given broker.
+    """
+    ki.close_producer()
+    ki.KafkaConsumer = lambda *topics, **options: FakeConsumer(broker, *topics, **options)
+    ki.KafkaProducer = lambda **options: FakeProducer(broker, **options)
@@ -16,9 +16,11 @@ import app.kafka_interface as ki
 
 
 def write_test_data(topic):
-    messages = get_topic_data()
-    for message in messages:
-        ki.write_msg_to_kafka(message, topic)
+    futures = ki.send_msgs(get_topic_data(), topic)
+    ki.flush_producer()
+    for future in futures:
+        # raise the error of any message the broker did not accept
+        future.get()
 
 
 def get_topic_data():
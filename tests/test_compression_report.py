@@ -0,0 +1,36 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+from testing import compression_report
+
+
+class CompressionReportTest(unittest.TestCase):
+
+    def test_report(self):
+        output = io.StringIO()
+        with mock.patch("sys.argv", ["compression_report", "--count", "50"]), \
+                contextlib.redirect_stdout(output):
+            compression_report.main()
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("50 deployments"))
+        self.assertEqual([line.split()[0] for line in lines[2:4]], ["none", "zlib"])
+        self.assertTrue(lines[-1].startswith("compress "))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sqlite3
+import unittest
+from app.ranking_processor import CREATE_RANKING_TABLE, _migrate_ranking_table
+
+logger = logging.getLogger(__name__)
+
+
+class MigrateRankingTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:", isolation_level=None)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def columns(self):
+        return {name: pk for _, name, _, _, _, pk in self.conn.execute('PRAGMA table_info(ranking_data);')}
+
+    def test_former_schema(self):
+        self.conn.execute('CREATE TABLE ranking_data (uuid TEXT, ts INTEGER, rank TEXT);')
+        self.conn.executemany('INSERT INTO ranking_data VALUES (?, ?, ?);', [
+            ("a", 1, "[1]"), ("a", 3, "[3]"), ("a", 2, "[2]"), ("b", 5, "[5]"), (None, 9, "[9]"),
+        ])
+        _migrate_ranking_table(self.conn, logger)
+        self.assertEqual(self.columns(), {"uuid": 1, "ts": 0, "rank": 0})
+        rows = self.conn.execute('SELECT uuid, ts, rank FROM ranking_data ORDER BY uuid;').fetchall()
+        self.assertEqual(rows, [("a", 3, "[3]"), ("b", 5, "[5]")])
+        tables = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
+        self.assertEqual(tables, [("ranking_data",)])
+
+    def test_current_schema_untouched(self):
+        self.conn.execute(CREATE_RANKING_TABLE)
+        self.conn.execute('INSERT INTO ranking_data VALUES (?, ?, ?);', ("a", 1, "[1]"))
+        _migrate_ranking_table(self.conn, logger)
+        self.assertEqual(self.conn.execute('SELECT * FROM ranking_data;').fetchall(), [("a", 1, "[1]")])
+
+    def test_no_table(self):
+        _migrate_ranking_table(self.conn, logger)
+        self.assertEqual(self.columns(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
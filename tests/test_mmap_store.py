@@ -0,0 +1,117 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from app.lib.mmap_store import MmapStoreReader, MmapStoreWriter
+
+
+class MmapStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "rankings")
+        self.writer = MmapStoreWriter(self.path, initial_capacity=8)
+        self.reader = MmapStoreReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        self.assertIsNone(self.reader.get("a"))
+        self.writer.put_many([("a", 1, b"[1]"), ("b", 2, b"[2]")])
+        self.assertEqual(self.reader.get("a"), (1, b"[1]"))
+        self.assertEqual(self.reader.get("b"), (2, b"[2]"))
+        self.assertIsNone(self.reader.get("c"))
+
+    def test_replace(self):
+        self.writer.put_many([("a", 1, b"[1]")])
+        self.writer.put_many([("a", 2, b"[2]")])
+        self.assertEqual(self.reader.get("a"), (2, b"[2]"))
+        # an older ranking never replaces a newer one, in the same batch or later
+        self.writer.put_many([("a", 1, b"[old]")])
+        self.writer.put_many([("b", 5, b"[5]"), ("b", 3, b"[3]")])
+        self.assertEqual(self.reader.get("a"), (2, b"[2]"))
+        self.assertEqual(self.reader.get("b"), (5, b"[5]"))
+        self.assertEqual(self.writer.stats()["count"], 2)
+        self.assertEqual(self.writer.stats()["dead"], 1)
+
+    def test_version(self):
+        version = self.reader.version()
+        self.writer.put_many([("a", 1, b"[1]")])
+        self.assertNotEqual(self.reader.version(), version)
+
+    def test_index_growth(self):
+        rankings = {f"d{i}": (i, f"[{i}]".encode()) for i in range(100)}
+        self.writer.put_many([("d0", 0, b"[0]")])
+        self.assertEqual(self.reader.get("d0"), (0, b"[0]"))
+        for i in range(0, 100, 10):
+            self.writer.put_many([(f"d{j}", *rankings[f"d{j}"]) for j in range(i, i + 10)])
+        self.assertGreaterEqual(self.writer.stats()["capacity"], 200)
+        # the reader opened before the index was rebuilt follows it
+        for uuid, ranking in rankings.items():
+            self.assertEqual(self.reader.get(uuid), ranking)
+
+    def test_compact(self):
+        self.writer.put_many([("a", 1, b"[1]"), ("b", 10, b"[10]"), ("c", 20, b"[20]")])
+        self.writer.put_many([("b", 11, b"[11]")])
+        self.assertEqual(self.reader.get("a"), (1, b"[1]"))
+        data_bytes = self.writer.stats()["data_bytes"]
+        self.assertEqual(self.writer.compact(cutoff=5), 1)
+        self.assertLess(self.writer.stats()["data_bytes"], data_bytes)
+        self.assertEqual(self.writer.stats()["dead"], 0)
+        self.assertIsNone(self.reader.get("a"))
+        self.assertEqual(self.reader.get("b"), (11, b"[11]"))
+        self.assertEqual(self.reader.get("c"), (20, b"[20]"))
+        self.writer.put_many([("d", 30, b"[30]")])
+        self.assertEqual(self.reader.get("d"), (30, b"[30]"))
+
+    def test_expire_before(self):
+        self.writer.put_many([("a", 1, b"[1]"), ("b", 10, b"[10]")])
+        self.writer.expire_before(5)
+        # not served any more, although still in the data file until compaction
+        self.assertIsNone(self.reader.get("a"))
+        self.assertEqual(self.reader.get("b"), (10, b"[10]"))
+        self.assertEqual(self.writer.stats()["count"], 2)
+        self.writer.maybe_compact(5, 1)
+        self.assertIsNone(self.reader.get("a"))
+        self.writer.clear()
+        self.writer.put_many([("a", 1, b"[1]")])
+        self.assertEqual(self.reader.get("a"), (1, b"[1]"))
+
+    def test_reopen(self):
+        self.writer.put_many([("a", 1, b"[1]"), ("b", 2, b"[2]")])
+        self.writer.close()
+        self.writer = MmapStoreWriter(self.path, initial_capacity=8)
+        self.assertEqual(self.writer.stats()["count"], 2)
+        self.writer.put_many([("a", 3, b"[3]")])
+        reader = MmapStoreReader(self.path)
+        try:
+            self.assertEqual(reader.get("a"), (3, b"[3]"))
+            self.assertEqual(reader.get("b"), (2, b"[2]"))
+        finally:
+            reader.close()
+
+    def test_missing_files(self):
+        reader = MmapStoreReader(os.path.join(self.tmpdir, "missing"))
+        self.assertIsNone(reader.get("a"))
+        self.assertIsNone(reader.version())
+
+
+if __name__ == "__main__":
+    unittest.main()
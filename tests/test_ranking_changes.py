@@ -0,0 +1,100 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import unittest
+from unittest import mock
+import app.kafka_interface as ki
+import app.ranking_processor as rp
+from app.lib import db
+from app.lib import store
+
+DB_CONNECTION = "file:test_ranking_changes?mode=memory&cache=shared"
+
+
+class RankingChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(ki, "db_connection", DB_CONNECTION)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the shared in-memory database lives as long as a connection to it
+        self.keepalive = sqlite3.connect(DB_CONNECTION)
+        self.addCleanup(self.keepalive.close)
+        self.addCleanup(db.close_connection)
+        for statement in (rp.CREATE_RANKING_TABLE, rp.CREATE_OFFSETS_TABLE, rp.CREATE_CHANGES_TABLE):
+            self.keepalive.execute(statement)
+        self.keepalive.commit()
+        self.store = store.SQLiteStore(track_changes=True)
+
+    def test_changes_since(self):
+        seq, changed = self.store.changes_since(None)
+        self.assertIsNone(changed)
+        self.store.put_many([("a", 1, b"[1]"), ("b", 1, b"[1]")])
+        self.store.put_many([("a", 2, b"[2]")])
+        last, changed = self.store.changes_since(seq)
+        self.assertEqual(changed, {"a", "b"})
+        self.assertEqual(self.store.changes_since(last), (last, ()))
+
+    def test_trimmed_changes(self):
+        seq, _ = self.store.changes_since(None)
+        with mock.patch.object(store, "CHANGES_KEPT", 2):
+            self.store.put_many([("a", 1, b"[1]"), ("b", 1, b"[1]"), ("c", 1, b"[1]")])
+        # the change of "a" is no longer recorded
+        self.assertEqual(self.store.changes_since(seq), (seq + 3, None))
+        self.assertEqual(self.store.changes_since(seq + 1), (seq + 3, {"b", "c"}))
+
+    def test_untracked(self):
+        seq, _ = self.store.changes_since(None)
+        store.SQLiteStore().put_many([("a", 1, b"[1]")])
+        self.assertEqual(self.store.changes_since(seq), (seq, ()))
+
+    def test_revalidate_caches(self):
+        cache = rp.RankingCache(lifespan=36500)
+        negative = rp.NegativeCache(ttl=60)
+        with mock.patch.object(rp, "_store", self.store), mock.patch.object(rp, "ranking_cache", cache), \
+                mock.patch.object(rp, "negative_cache", negative), mock.patch.object(rp, "_ingest_local", False), \
+                mock.patch.object(rp, "_db_poll_interval", 0), mock.patch.object(rp, "_cache_seq", None), \
+                mock.patch.object(rp, "_cache_checked", 0.0):
+            rp._revalidate_caches()
+            cache.put("a", 1, b"[1]")
+            cache.put("b", 1, b"[1]")
+            negative.add("c")
+            negative.add("d")
+            self.store.put_many([("a", 2, b"[2]"), ("c", 2, b"[2]")])
+            rp._revalidate_caches()
+            # only the stored uuids are dropped
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b"), b"[1]")
+            self.assertNotIn("c", negative)
+            self.assertIn("d", negative)
+            self.assertEqual(rp._lookup_ranking_data("a"), b"[2]")
+            self.assertEqual(cache.get("a"), b"[2]")
+
+    def test_stale_read_not_cached(self):
+        cache = rp.RankingCache(lifespan=36500)
+        with mock.patch.object(rp, "_store", self.store), mock.patch.object(rp, "ranking_cache", cache), \
+                mock.patch.object(rp, "_ingest_local", False), mock.patch.object(rp, "_db_poll_interval", 0), \
+                mock.patch.object(rp, "_cache_seq", None), mock.patch.object(rp, "_cache_checked", 0.0):
+            rp._revalidate_caches()
+            seq = rp._cache_seq
+            self.store.put_many([("a", 2, b"[2]")])
+            rp._revalidate_caches()
+            # read before the change was applied to the caches
+            rp._cache_rankings({"a": (1, b"[1]")}, seq)
+            self.assertIsNone(cache.get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+from app import create_app
+from testing import fake_kafka
+
+TOPIC = "ranked-providers"
+
+
+class RankTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.broker = broker = fake_kafka.FakeBroker()
+        fake_kafka.install(broker)
+        for message in (
+            {"uuid": "ranked", "ranked_providers": [{"provider_name": "BACKBONE", "rank": 0.9}]},
+            {"uuid": "empty", "ranked_providers": []},
+            {"ranked_providers": None, "uuid": "null"},
+        ):
+            broker.append(TOPIC, json.dumps(message).encode("utf-8"))
+        # configured by tests/resources/config.json
+        with mock.patch.dict(os.environ, {"TESTING": "true"}):
+            cls.app = create_app()
+        cls.client = cls.app.test_client()
+        # ready once the messages sent before the start are stored
+        deadline = time.monotonic() + 10
+        while cls.client.get("/cpr/ready").status_code != 200 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def test_ranked(self):
+        response = self.client.post("/cpr/rank", data="ranked")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [{"provider_name": "BACKBONE", "rank": 0.9}])
+
+    def test_without_providers(self):
+        for uuid in ("empty", "null"):
+            self.assertEqual(self.client.post("/cpr/rank", data=uuid).status_code, 404)
+
+    def test_missing(self):
+        self.assertEqual(self.client.post("/cpr/rank", data="missing").status_code, 404)
+
+    def test_slow_ranking_retry(self):
+        # the AI-Ranker publishes after QUERY_TIMEOUT: the retry must still wait for it
+        self.assertEqual(self.client.post("/cpr/rank", data="slow").status_code, 404)
+        message = json.dumps({"uuid": "slow", "ranked_providers": [{"provider_name": "SLOW"}]}).encode("utf-8")
+        publish = threading.Timer(0.05, self.broker.append, args=(TOPIC, message))
+        publish.start()
+        try:
+            response = self.client.post("/cpr/rank", data="slow")
+        finally:
+            publish.join()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [{"provider_name": "SLOW"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sqlite3
+import time
+import unittest
+from unittest import mock
+import app.kafka_interface as ki
+import app.ranking_processor as rp
+from app.lib import db
+from app.lib import store
+
+DB_CONNECTION = "file:test_retention?mode=memory&cache=shared"
+DAY_MS = 86400 * 1000
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(ki, "db_connection", DB_CONNECTION)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the shared in-memory database lives as long as a connection to it
+        self.conn = sqlite3.connect(DB_CONNECTION)
+        self.addCleanup(self.conn.close)
+        self.addCleanup(db.close_connection)
+        self.conn.execute(rp.CREATE_RANKING_TABLE)
+        self.conn.execute(rp.CREATE_RANKING_TS_INDEX)
+        self.conn.commit()
+        self.store = store.SQLiteStore()
+        patcher = mock.patch.object(rp, "_store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def insert(self, rows):
+        self.conn.executemany('INSERT INTO ranking_data VALUES (?, ?, ?);', rows)
+        self.conn.commit()
+
+    def uuids(self):
+        return {row[0] for row in self.conn.execute('SELECT uuid FROM ranking_data;')}
+
+    def test_expired_row_removed(self):
+        now = int(time.time() * 1000)
+        self.insert([("old", now - 2 * DAY_MS, "[1]"), ("new", now - DAY_MS // 2, "[2]")])
+        self.assertEqual(rp.clean_ranking_data(1, logger), 1)
+        self.assertEqual(self.uuids(), {"new"})
+
+    def test_cutoff(self):
+        self.insert([("a", 999, "[1]"), ("b", 1000, "[2]")])
+        self.assertEqual(self.store.expire_before(1000), 1)
+        self.assertEqual(self.uuids(), {"b"})
+
+    def test_max_batches(self):
+        now = int(time.time() * 1000)
+        self.insert([(f"old{i}", now - 2 * DAY_MS, "[1]") for i in range(10)] + [("new", now, "[2]")])
+        self.assertEqual(rp.clean_ranking_data(1, logger, batch_size=2, max_batches=3), 6)
+        self.assertEqual(len(self.uuids()), 5)
+        # the next run removes the rest
+        self.assertEqual(rp.clean_ranking_data(1, logger, batch_size=2, max_batches=3), 4)
+        self.assertEqual(self.uuids(), {"new"})
+
+
+if __name__ == "__main__":
+    unittest.main()
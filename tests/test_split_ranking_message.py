@@ -0,0 +1,77 @@
+# Copyright (c) Istituto Nazionale di Fisica Nucleare (INFN). 2019-2025
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from app.ranking_processor import is_empty_ranking, split_ranking_message
+
+PROVIDERS = b'[{"provider_name":"BACKBONE","region_name":"RegionOne","rank":0.9}]'
+
+
+class SplitRankingMessageTest(unittest.TestCase):
+
+    def test_uuid_first(self):
+        raw = b'{"uuid": "d1", "ranked_providers": ' + PROVIDERS + b'}'
+        self.assertEqual(split_ranking_message(raw), ("d1", PROVIDERS))
+
+    def test_ranked_providers_first(self):
+        raw = b'{"ranked_providers":' + PROVIDERS + b',"uuid":"d1"}'
+        self.assertEqual(split_ranking_message(raw), ("d1", PROVIDERS))
+
+    def test_nested_uuid_keys(self):
+        providers = [{"uuid": "provider", "rank": 1}, {"uuid": "other", "rank": 2}]
+        for value in ({"uuid": "d1", "ranked_providers": providers},
+                      {"ranked_providers": providers, "uuid": "d1"}):
+            uuid, rank = split_ranking_message(json.dumps(value).encode())
+            self.assertEqual(uuid, "d1")
+            self.assertEqual(json.loads(rank), providers)
+
+    def test_closing_bracket_in_strings(self):
+        providers = [{"provider_name": "a]b", "region_name": "]"}]
+        for value in ({"uuid": "d1", "ranked_providers": providers},
+                      {"ranked_providers": providers, "uuid": "d1"},
+                      {"uuid": "d]1", "ranked_providers": providers}):
+            uuid, rank = split_ranking_message(json.dumps(value).encode())
+            self.assertEqual(uuid, value["uuid"])
+            self.assertEqual(json.loads(rank), providers)
+
+    def test_other_members(self):
+        raw = b'{"uuid": "d1", "ranked_providers": ' + PROVIDERS + b', "version": 2}'
+        uuid, rank = split_ranking_message(raw)
+        self.assertEqual(uuid, "d1")
+        self.assertEqual(json.loads(rank), json.loads(PROVIDERS))
+
+    def test_empty_and_null_rankings(self):
+        self.assertEqual(split_ranking_message(b'{"uuid": "d1", "ranked_providers": []}'), ("d1", b'[]'))
+        uuid, rank = split_ranking_message(b'{"ranked_providers": null, "uuid": "d1"}')
+        self.assertEqual((uuid, json.loads(rank)), ("d1", None))
+
+    def test_missing_member(self):
+        with self.assertRaises(KeyError):
+            split_ranking_message(b'{"uuid": "d1"}')
+
+
+class IsEmptyRankingTest(unittest.TestCase):
+
+    def test_empty(self):
+        for ranking in (None, b'', b'[]', b' [ ] ', b'null', b'{}'):
+            self.assertTrue(is_empty_ranking(ranking), ranking)
+
+    def test_not_empty(self):
+        for ranking in (PROVIDERS, b'[0]', b'[null]'):
+            self.assertFalse(is_empty_ranking(ranking), ranking)
+
+
+if __name__ == "__main__":
+    unittest.main()